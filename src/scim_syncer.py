@@ -1,48 +1,464 @@
+import asyncio
+import atexit
+import functools
+import itertools
 import logging
+import logging.handlers
 import os
+import random
 import sys
+import time
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 
-from azure.identity import DefaultAzureCredential
+import httpx
+# The async credential cooperates with the event loop; the sync variant would
+# block it on every token acquisition.
+from azure.identity.aio import DefaultAzureCredential
+import orjson
 from dotenv import load_dotenv
-from msgraph import GraphServiceClient
+from kiota_abstractions.api_error import APIError
+from kiota_abstractions.base_request_configuration import RequestConfiguration
+from kiota_abstractions.headers_collection import HeadersCollection
+from kiota_abstractions.serialization import ParseNode, ParseNodeFactoryRegistry, SerializationWriterFactoryRegistry
+from kiota_authentication_azure.azure_identity_authentication_provider import AzureIdentityAuthenticationProvider
+from kiota_serialization_json.json_parse_node import JsonParseNode
+from kiota_serialization_json.json_parse_node_factory import JsonParseNodeFactory
+from kiota_serialization_json.json_serialization_writer import JsonSerializationWriter
+from kiota_serialization_json.json_serialization_writer_factory import JsonSerializationWriterFactory
+from msgraph import GraphRequestAdapter, GraphServiceClient
+from msgraph.generated.models.o_data_errors.main_error import MainError
 from msgraph.generated.models.o_data_errors.o_data_error import ODataError
-# Import for explicit request configuration
+from msgraph.generated.models.synchronization_job_subject import SynchronizationJobSubject
+from msgraph.generated.models.user import User
+from msgraph_core import GraphClientFactory
+# Imports for explicit request configuration
+from msgraph.generated.groups.groups_request_builder import GroupsRequestBuilder
+from msgraph.generated.groups.item.transitive_members.graph_user.graph_user_request_builder import GraphUserRequestBuilder
+from msgraph.generated.service_principals.item.app_role_assigned_to.app_role_assigned_to_request_builder import AppRoleAssignedToRequestBuilder
 from msgraph.generated.service_principals.service_principals_request_builder import ServicePrincipalsRequestBuilder
+from msgraph.generated.audit_logs.provisioning.provisioning_request_builder import ProvisioningRequestBuilder
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)],
+# Configure logging. Records are buffered in memory and flushed to stdout in
+# batches, so large runs do not pay one write() syscall (and the stdout handler
+# lock that serializes concurrent workers) per record. ERROR-level records and
+# process exit flush the buffer immediately.
+LOG_BUFFER_CAPACITY = 1024
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 )
+_log_memory_handler = logging.handlers.MemoryHandler(
+    capacity=LOG_BUFFER_CAPACITY,
+    flushLevel=logging.ERROR,
+    target=_log_stream_handler,
+)
+logging.basicConfig(level=logging.INFO, handlers=[_log_memory_handler])
+atexit.register(_log_memory_handler.flush)
 logger = logging.getLogger(__name__)
 
 # Configuration
 # AZURE_APP_ID = os.getenv("AZURE_APP_ID") # Remove global assignment
 
+# Microsoft Graph JSON batching allows at most 20 sub-requests per $batch POST.
+GRAPH_BATCH_SIZE = 20
+# How many times a $batch chunk is retried when sub-requests are throttled (429/503).
+BATCH_MAX_RETRIES = 3
+# Fallback wait (seconds) when a throttled sub-response carries no Retry-After header.
+BATCH_DEFAULT_RETRY_AFTER_SECONDS = 5.0
+# Upper bound on concurrent Graph requests when fanning out per-group work,
+# overridable via SCIM_CONCURRENCY for tenants with different throttling budgets.
+# Bounded to stay well clear of Graph service throttling limits. HTTP/2 streams
+# are cheap, so this can sit above the ~6-connection HTTP/1.1 per-host ceiling.
+GRAPH_CONCURRENCY_LIMIT = int(os.getenv("SCIM_CONCURRENCY", "20"))
+# Bound on the discovery->provisioning hand-off queue so a fast producer cannot
+# buffer an unbounded number of user IDs ahead of the provisioning workers.
+PROVISION_QUEUE_MAXSIZE = 200
+# How many group IDs fit comfortably in one "id in (...)" filter (URL length limit).
+GROUPS_FILTER_CHUNK_SIZE = 15
+# When non-zero, users successfully provisioned within the last N hours (per
+# the provisioning audit log) are skipped on the next on-demand run. Opt-in:
+# forcing re-provisioning is the usual reason to run on demand.
+RECENT_PROVISION_SKIP_HOURS = float(os.getenv("SCIM_SKIP_RECENTLY_PROVISIONED_HOURS", "0"))
+# Where per-group delta links are persisted between runs (JSON, group ID -> deltaLink).
+DELTA_LINK_STORE_PATH = os.getenv("SCIM_DELTA_LINK_STORE", ".scim_delta_links.json")
+# Delta links older than this are discarded on load, forcing a periodic full
+# transitive resync: /groups/delta tracks direct members only, so membership
+# changes inside nested sub-groups are invisible to the delta fast path. Set
+# to 0 to keep links until Graph expires them (only safe for flat groups).
+DELTA_FULL_RESYNC_HOURS = float(os.getenv("SCIM_DELTA_FULL_RESYNC_HOURS", "168"))
+# $deltaToken=latest returns no members but yields a deltaLink anchored at "now",
+# letting a full sync establish the fast path for the next run without a drain.
+_GROUP_DELTA_LATEST_URL = (
+    "https://graph.microsoft.com/v1.0/groups/delta"
+    "?$deltaToken=latest&$filter=id eq '{group_id}'"
+)
+# Graph returns at most this many items in an expanded collection; a group whose
+# expansion hits the cap may be truncated and must be re-read with paging.
+GRAPH_EXPAND_MEMBER_LIMIT = 20
+
+# Request configurations are immutable per call site, so build them once at
+# import time instead of allocating a fresh configurator closure per request
+# (the SDK re-invokes the configurator for every page when paging).
+_ASSIGNED_GROUPS_CONFIG = RequestConfiguration(
+    headers=HeadersCollection(),
+    query_parameters=AppRoleAssignedToRequestBuilder.AppRoleAssignedToRequestBuilderGetQueryParameters(
+        filter="principalType eq 'Group'",
+        # Select principalId (group id) and principalDisplayName (group name)
+        select=["principalId", "principalDisplayName"],
+        # Request the Graph maximum page size to minimise paging round-trips,
+        # and enable server-side counting for the advanced query.
+        top=999,
+        count=True,
+    ),
+)
+_ASSIGNED_GROUPS_CONFIG.headers.add("ConsistencyLevel", "eventual")
+
+# Members are read through /transitiveMembers/microsoft.graph.user, which
+# resolves nested group membership server-side and casts away non-user
+# principals, so no client-side recursion or type filtering is needed. The
+# cast is an advanced query: it needs $count=true and ConsistencyLevel
+# eventual. Only the ID is needed for provisioning; the verbose variant adds
+# the diagnostic identity fields and is used when DEBUG logging is enabled.
+_GROUP_MEMBERS_CONFIG = RequestConfiguration(
+    headers=HeadersCollection(),
+    query_parameters=GraphUserRequestBuilder.GraphUserRequestBuilderGetQueryParameters(
+        select=["id"],
+        top=999,
+        count=True,
+    ),
+)
+_GROUP_MEMBERS_CONFIG.headers.add("ConsistencyLevel", "eventual")
+_GROUP_MEMBERS_CONFIG_VERBOSE = RequestConfiguration(
+    headers=HeadersCollection(),
+    query_parameters=GraphUserRequestBuilder.GraphUserRequestBuilderGetQueryParameters(
+        select=["id", "displayName", "userPrincipalName", "userType"],
+        top=999,
+        count=True,
+    ),
+)
+_GROUP_MEMBERS_CONFIG_VERBOSE.headers.add("ConsistencyLevel", "eventual")
+
+# Retry policy for individually throttled Graph calls (HTTP 429/503):
+# up to 3 retries with exponential backoff, capped per wait.
+GRAPH_RETRY_MAX_ATTEMPTS = 4
+GRAPH_RETRY_MAX_WAIT_SECONDS = 30.0
+
+
+def _is_auth_failure(error: Exception) -> bool:
+    """
+    Returns True when a Graph error is an unrecoverable authorization failure
+    (HTTP 401/403). Retrying these only burns through the tenant's rate budget,
+    so callers fanning out work should abort instead.
+
+    Matches any kiota APIError, not just ODataError: requests issued through
+    builders without an error mapping (e.g. the $batch endpoint) surface
+    envelope-level failures as plain APIError.
+
+    Args:
+        error: The exception raised by a Graph call.
+    """
+    return (
+        isinstance(error, APIError)
+        and getattr(error, "response_status_code", None) in (401, 403)
+    )
+
+
+def _is_throttled(error: Exception) -> bool:
+    """
+    Returns True when a Graph error represents service throttling (HTTP 429/503).
+
+    Args:
+        error: The exception raised by a Graph call.
+    """
+    return (
+        isinstance(error, ODataError)
+        and getattr(error, "response_status_code", None) in (429, 503)
+    )
+
+
+def _throttle_wait_seconds(error: ODataError, attempt: int) -> float:
+    """
+    Determines how long to wait before retrying a throttled Graph call, honouring
+    the Retry-After response header when present and falling back to exponential
+    backoff (2**attempt seconds plus up to 1s of jitter) otherwise. The jitter
+    stops concurrent workers throttled together from all retrying together.
+
+    Args:
+        error: The throttled ODataError.
+        attempt: The 1-based attempt number that just failed.
+
+    Returns:
+        float: The number of seconds to wait, capped at GRAPH_RETRY_MAX_WAIT_SECONDS.
+    """
+    headers = getattr(error, "response_headers", None) or {}
+    header_value = headers.get("Retry-After") or headers.get("retry-after")
+    if header_value:
+        try:
+            return min(float(header_value), GRAPH_RETRY_MAX_WAIT_SECONDS)
+        except (TypeError, ValueError):
+            logger.warning("Could not parse Retry-After header value: %r", header_value)
+    return min(float(2 ** attempt) + random.random(), GRAPH_RETRY_MAX_WAIT_SECONDS)
+
+
+async def _call_with_throttle_retry(call, description: str):
+    """
+    Awaits `call()` and retries it when Graph responds with 429/503, sleeping
+    per _throttle_wait_seconds between attempts. Non-throttling errors (and
+    throttling past the final attempt) propagate to the caller unchanged.
+
+    Args:
+        call: A zero-argument callable returning an awaitable.
+        description: A short label for log messages (e.g. the function name).
+    """
+    for attempt in range(1, GRAPH_RETRY_MAX_ATTEMPTS + 1):
+        try:
+            return await call()
+        except ODataError as o_data_error:
+            if not _is_throttled(o_data_error) or attempt == GRAPH_RETRY_MAX_ATTEMPTS:
+                raise
+            wait_seconds = _throttle_wait_seconds(o_data_error, attempt)
+            logger.warning(
+                "Graph throttled %s (HTTP %s); retrying in %.1fs (attempt %d/%d).",
+                description, o_data_error.response_status_code, wait_seconds,
+                attempt, GRAPH_RETRY_MAX_ATTEMPTS - 1,
+            )
+            await asyncio.sleep(wait_seconds)
+
+
+def _retry_on_throttle(func):
+    """
+    Decorator applying _call_with_throttle_retry to an async Graph call.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await _call_with_throttle_retry(lambda: func(*args, **kwargs), func.__name__)
+    return wrapper
+
+class _OrjsonParseNode(JsonParseNode):
+    """JsonParseNode whose payloads were decoded by orjson instead of stdlib json."""
+
+
+class _OrjsonParseNodeFactory(JsonParseNodeFactory):
+    """
+    ParseNodeFactory that decodes application/json payloads with orjson,
+    which is significantly faster than the stdlib json module on the large
+    $batch response bodies.
+    """
+
+    def get_root_parse_node(self, content_type: str, content: bytes) -> ParseNode:
+        if not content_type:
+            raise TypeError("Content Type cannot be null")
+        valid_content_type = self.get_valid_content_type()
+        if valid_content_type.casefold() != content_type.casefold():
+            raise TypeError(f"Expected {valid_content_type} as content type")
+        if not content:
+            raise TypeError("Content cannot be null")
+        return _OrjsonParseNode(orjson.loads(content))
+
+
+class _OrjsonSerializationWriter(JsonSerializationWriter):
+    """JsonSerializationWriter that encodes its content with orjson."""
+
+    def get_serialized_content(self) -> bytes:
+        if self.writer and self.value:
+            # Json output is invalid if it has a mix of values and key-value pairs.
+            raise ValueError("Invalid Json output")
+        if self.value:
+            # default=str matches stdlib json's tolerance for the odd
+            # non-primitive leaf the writer did not pre-convert.
+            content = orjson.dumps(self.value, default=str)
+            self.value = None
+        else:
+            content = orjson.dumps(self.writer, default=str)
+            self.writer.clear()
+        return content
+
+
+class _OrjsonSerializationWriterFactory(JsonSerializationWriterFactory):
+    """SerializationWriterFactory producing orjson-backed writers."""
+
+    def get_serialization_writer(self, content_type: str) -> _OrjsonSerializationWriter:
+        if not content_type:
+            raise TypeError("Content Type cannot be null")
+        valid_content_type = self.get_valid_content_type()
+        if valid_content_type.casefold() != content_type.casefold():
+            raise TypeError(f"Expected {valid_content_type} as content type")
+        return _OrjsonSerializationWriter()
+
+
+def _register_orjson_serialization() -> None:
+    """
+    Points the Kiota registries' application/json factories at the orjson-backed
+    implementations. Must run after GraphServiceClient construction, which
+    registers the stdlib-json defaults into the same singleton registries.
+    """
+    ParseNodeFactoryRegistry().CONTENT_TYPE_ASSOCIATED_FACTORIES[
+        "application/json"] = _OrjsonParseNodeFactory()
+    SerializationWriterFactoryRegistry().CONTENT_TYPE_ASSOCIATED_FACTORIES[
+        "application/json"] = _OrjsonSerializationWriterFactory()
+    logger.debug("Registered orjson-backed JSON serialization factories.")
+
+
+# Connection-pool tuning for the shared HTTP transport. Reusing one pooled
+# AsyncClient means only the first request pays the TCP+TLS handshake.
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+# Keep idle connections warm across the gaps between Graph bursts.
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 60.0
+HTTP_TIMEOUT_SECONDS = 30.0
+HTTP_CONNECT_TIMEOUT_SECONDS = 10.0
+
+# Module-level singletons so every Graph call in a process shares one connection
+# pool and one client. Reset to None by close_graph_client().
+_http_client: httpx.AsyncClient | None = None
+_graph_client: GraphServiceClient | None = None
+# The credential is cached separately from the Graph client so its in-memory
+# token cache (~1h validity) survives a client rebuild and repeated runs within
+# one process never re-hit AAD while the token is still valid.
+_credential: DefaultAzureCredential | None = None
+
+
+def _get_credential() -> DefaultAzureCredential:
+    """
+    Returns the shared DefaultAzureCredential, creating it on first use.
+
+    Returns:
+        DefaultAzureCredential: The process-wide credential with its token cache.
+    """
+    global _credential
+    if _credential is None:
+        _credential = DefaultAzureCredential()
+    return _credential
+
+# The app_id -> (service principal ID, job ID) mapping is effectively immutable
+# for hours, so cache it and skip two sequential Graph round-trips on warm runs.
+SYNC_TARGET_CACHE_TTL_SECONDS = 43200  # 12 hours
+_sync_target_cache: dict[str, tuple[str, str, float]] = {}
+
+
+def invalidate_sync_target(app_id: str) -> None:
+    """
+    Drops the cached service principal / job IDs for an application, forcing the
+    next resolve_sync_target call to hit Microsoft Graph again.
+
+    Args:
+        app_id: The application (client) ID whose cache entry should be dropped.
+    """
+    if _sync_target_cache.pop(app_id, None) is not None:
+        logger.info("Invalidated cached sync target for app ID: %s", app_id)
+
+
+def _invalidate_if_resource_not_found(app_id: str, error: Exception) -> None:
+    """
+    Invalidates the cached sync target when a Graph error indicates the cached
+    IDs no longer exist (e.g. the enterprise application was recreated).
+
+    Args:
+        app_id: The application (client) ID whose cache entry may be stale.
+        error: The exception raised by a Graph call.
+    """
+    if isinstance(error, ODataError):
+        code = getattr(error.error, "code", None) if error.error else None
+        if code == "Request_ResourceNotFound":
+            invalidate_sync_target(app_id)
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the shared httpx AsyncClient, creating it (with Graph's default
+    middleware and tuned connection-pool limits) on first use.
+
+    Returns:
+        httpx.AsyncClient: The shared HTTP client used by the Graph request adapter.
+    """
+    global _http_client
+    if _http_client is None:
+        # http2=True lets concurrent requests multiplex over one TCP+TLS
+        # connection instead of queueing behind HTTP/1.1's per-host limit.
+        _http_client = GraphClientFactory.create_with_default_middleware(
+            client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+                ),
+                timeout=httpx.Timeout(
+                    HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS
+                ),
+            )
+        )
+        logger.debug("Created shared HTTP client with HTTP/2 multiplexing enabled.")
+    return _http_client
+
+
+async def close_graph_client() -> None:
+    """
+    Closes the shared HTTP client and credential and drops the cached Graph client.
+
+    Call this once at process shutdown; subsequent calls to get_graph_client
+    will transparently rebuild the shared transport.
+    """
+    global _http_client, _graph_client, _credential
+    if _http_client is not None:
+        await _http_client.aclose()
+        logger.info("Closed shared HTTP client.")
+    if _credential is not None:
+        await _credential.close()
+        logger.info("Closed shared Azure credential.")
+    _http_client = None
+    _graph_client = None
+    _credential = None
+
+
+def _chunked(items, size: int):
+    """
+    Yields successive lists of at most `size` items from `items`.
+
+    Args:
+        items: An iterable of items to chunk.
+        size: The maximum number of items per chunk.
+    """
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
 
 async def get_graph_client() -> GraphServiceClient:
     """
     Initializes and returns a Microsoft GraphServiceClient using DefaultAzureCredential.
 
+    The client is cached at module level and rides the shared pooled HTTP
+    transport, so repeated calls within a process reuse connections instead of
+    paying a TCP+TLS handshake per request.
+
     Returns:
         GraphServiceClient: An initialized Microsoft Graph client.
     """
+    global _graph_client
+    if _graph_client is not None:
+        return _graph_client
     logger.info("Authenticating with Azure using DefaultAzureCredential.")
     try:
-        credential = DefaultAzureCredential()
+        credential = _get_credential()
         scopes = ["https://graph.microsoft.com/.default"]
-        graph_client = GraphServiceClient(credentials=credential, scopes=scopes)
+        auth_provider = AzureIdentityAuthenticationProvider(credential, scopes=scopes)
+        adapter = GraphRequestAdapter(auth_provider, client=_get_http_client())
+        _graph_client = GraphServiceClient(request_adapter=adapter)
+        _register_orjson_serialization()
         logger.info("Successfully authenticated and Graph client created.")
-        return graph_client
+        return _graph_client
     except Exception as e:
-        logger.error(f"Authentication failed: {e}")
+        logger.error("Authentication failed: %s", e)
         raise
 
 
+@_retry_on_throttle
 async def get_service_principal_id(
     graph_client: GraphServiceClient, app_id: str
 ) -> str | None:
@@ -56,15 +472,15 @@ async def get_service_principal_id(
     Returns:
         str | None: The object ID of the service principal, or None if not found.
     """
-    logger.info(f"Retrieving service principal for app ID: {app_id}")
+    logger.info("Retrieving service principal for app ID: %s", app_id)
     try:
-        # Explicitly create and configure the request configuration object
-        query_params = ServicePrincipalsRequestBuilder.ServicePrincipalsRequestBuilderGetQueryParameters(
-            filter=f"appId eq '{app_id}'",
-            select=["id", "appId", "displayName"]
-        )
-        config = ServicePrincipalsRequestBuilder.ServicePrincipalsRequestBuilderGetRequestConfiguration(
-            query_parameters=query_params
+        # The $filter depends on app_id, so this config cannot be a module-level
+        # singleton like the others; the call runs once per (cached) resolution.
+        config = RequestConfiguration(
+            query_parameters=ServicePrincipalsRequestBuilder.ServicePrincipalsRequestBuilderGetQueryParameters(
+                filter=f"appId eq '{app_id}'",
+                select=["id", "appId", "displayName"],
+            )
         )
 
         service_principals = await graph_client.service_principals.get(
@@ -76,19 +492,20 @@ async def get_service_principal_id(
             # Ensure attribute access is safe with getattr, providing default if None
             sp_display_name = getattr(sp, 'display_name', 'N/A') # Already good
             app_display_name = getattr(sp, 'app_display_name', 'N/A') # Already good
-            logger.info(f"Found service principal: ID '{sp_id}', App Display Name: '{app_display_name}', SP Display Name: '{sp_display_name}' for App ID: {app_id}")
+            logger.info("Found service principal: ID '%s', App Display Name: '%s', SP Display Name: '%s' for App ID: %s", sp_id, app_display_name, sp_display_name, app_id)
             return sp_id
         else:
-            logger.warning(f"Service principal not found for app ID: {app_id}")
+            logger.warning("Service principal not found for app ID: %s", app_id)
             return None
     except ODataError as o_data_error:
-        logger.error(f"OData error retrieving service principal for app ID {app_id}: {o_data_error.error.message}")
+        logger.error("OData error retrieving service principal for app ID %s: %s", app_id, o_data_error.error.message)
         raise
     except Exception as e:
-        logger.error(f"Error retrieving service principal for app ID {app_id}: {e}")
+        logger.error("Error retrieving service principal for app ID %s: %s", app_id, e)
         raise
 
 
+@_retry_on_throttle
 async def get_synchronization_job_id(
     graph_client: GraphServiceClient, service_principal_id: str
 ) -> str | None:
@@ -104,7 +521,7 @@ async def get_synchronization_job_id(
         str | None: The ID of the synchronization job, or None if not found.
     """
     logger.info(
-        f"Retrieving synchronization jobs for service principal ID: {service_principal_id}"
+        "Retrieving synchronization jobs for service principal ID: %s", service_principal_id
     )
     try:
         jobs_response = (
@@ -118,23 +535,76 @@ async def get_synchronization_job_id(
             # Add logic here to select the correct job if multiple exist,
             # e.g., by checking job.template_id or job.schedule.status == "Active"
             job_id = jobs_response.value[0].id
-            logger.info(f"Found synchronization job ID: {job_id}")
+            logger.info("Found synchronization job ID: %s", job_id)
             return job_id
         else:
             logger.warning(
-                f"No synchronization jobs found for service principal ID: {service_principal_id}"
+                "No synchronization jobs found for service principal ID: %s", service_principal_id
             )
             return None
     except ODataError as o_data_error:
         logger.error(
-            f"OData error retrieving synchronization jobs: {o_data_error.error.message}"
+            "OData error retrieving synchronization jobs: %s", o_data_error.error.message
         )
         raise
     except Exception as e:
-        logger.error(f"Error retrieving synchronization jobs: {e}")
+        logger.error("Error retrieving synchronization jobs: %s", e)
         raise
 
 
+async def resolve_sync_target(
+    graph_client: GraphServiceClient, app_id: str
+) -> tuple[str | None, str | None]:
+    """
+    Resolves the service principal ID and synchronization job ID for an application,
+    caching the pair with a 12-hour TTL so warm invocations skip both Graph lookups.
+    Setting AZURE_SP_OBJECT_ID and AZURE_SYNC_JOB_ID bypasses discovery entirely;
+    either one alone short-circuits just its own lookup.
+
+    Args:
+        graph_client: The Microsoft Graph client.
+        app_id: The application (client) ID of the enterprise application.
+
+    Returns:
+        tuple[str | None, str | None]: The (service principal ID, job ID) pair;
+                                       either element is None when not found.
+    """
+    # Operators who already know the IDs (both are shown in the Portal) can
+    # pass them directly and skip the discovery round-trips entirely.
+    env_sp_id = os.getenv("AZURE_SP_OBJECT_ID")
+    env_job_id = os.getenv("AZURE_SYNC_JOB_ID")
+    if env_sp_id and env_job_id:
+        logger.info(
+            "Using sync target from environment for app ID %s: SP ID '%s', Job ID '%s'.",
+            app_id, env_sp_id, env_job_id,
+        )
+        return env_sp_id, env_job_id
+
+    cached = _sync_target_cache.get(app_id)
+    if cached:
+        service_principal_id, job_id, cached_at = cached
+        if time.time() - cached_at < SYNC_TARGET_CACHE_TTL_SECONDS:
+            logger.info(
+                "Using cached sync target for app ID %s: SP ID '%s', Job ID '%s'.",
+                app_id, service_principal_id, job_id,
+            )
+            return service_principal_id, job_id
+        # Entry expired; fall through to a fresh lookup.
+        del _sync_target_cache[app_id]
+
+    service_principal_id = env_sp_id or await get_service_principal_id(graph_client, app_id)
+    if not service_principal_id:
+        return None, None
+
+    job_id = env_job_id or await get_synchronization_job_id(graph_client, service_principal_id)
+    if not job_id:
+        return service_principal_id, None
+
+    _sync_target_cache[app_id] = (service_principal_id, job_id, time.time())
+    return service_principal_id, job_id
+
+
+@_retry_on_throttle
 async def start_synchronization_job(
     graph_client: GraphServiceClient, service_principal_id: str, job_id: str
 ) -> None:
@@ -147,7 +617,8 @@ async def start_synchronization_job(
         job_id: The ID of the synchronization job to start.
     """
     logger.info(
-        f"Starting synchronization job ID: {job_id} for service principal ID: {service_principal_id}"
+        "Starting synchronization job ID: %s for service principal ID: %s",
+        job_id, service_principal_id,
     )
     try:
         # The StartPostRequestBody is empty as per typical SDK usage for this action.
@@ -155,45 +626,73 @@ async def start_synchronization_job(
         await graph_client.service_principals.by_service_principal_id(
             service_principal_id
         ).synchronization.jobs.by_synchronization_job_id(job_id).start.post()
-        logger.info(f"Successfully initiated synchronization job ID: {job_id}")
+        logger.info("Successfully initiated synchronization job ID: %s", job_id)
     except ODataError as o_data_error:
         logger.error(
-            f"OData error starting synchronization job: {o_data_error.error.message}"
+            "OData error starting synchronization job: %s", o_data_error.error.message
         )
         raise
     except Exception as e:
-        logger.error(f"Error starting synchronization job: {e}")
+        logger.error("Error starting synchronization job: %s", e)
         raise
 
 
-async def main():
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Runtime configuration, read from the environment exactly once per process
+    so the workflows do not re-parse env vars (and misconfiguration surfaces
+    before any authentication work is done).
+    """
+    app_id: str | None
+    on_demand: bool
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        """
+        Builds the configuration from environment variables.
+
+        Returns:
+            Config: The parsed configuration; app_id is None when unset.
+        """
+        return cls(
+            app_id=os.getenv("AZURE_APP_ID"),
+            on_demand=os.getenv("RUN_ON_DEMAND_PROVISIONING", "false").lower() == "true",
+        )
+
+
+async def main(app_id: str | None = None):
     """
     Main function to orchestrate SCIM provisioning.
+
+    Args:
+        app_id: The application (client) ID to sync; read from AZURE_APP_ID
+                when omitted.
     """
     logger.info("Starting SCIM provisioning process.")
     graph_client = None
+    app_id_to_sync = None
     try:
-        # Get AZURE_APP_ID inside the function
-        app_id_to_sync = os.getenv("AZURE_APP_ID")
+        app_id_to_sync = app_id if app_id is not None else os.getenv("AZURE_APP_ID")
         if not app_id_to_sync:
             logger.error("AZURE_APP_ID environment variable not set. Cannot run main sync.")
             return
 
         graph_client = await get_graph_client()
 
-        service_principal_id = await get_service_principal_id(
+        service_principal_id, job_id = await resolve_sync_target(
             graph_client, app_id_to_sync # Use local variable
         )
         if not service_principal_id:
             logger.error(
-                f"Could not find service principal for app ID {app_id_to_sync}. Exiting."
+                "Could not find service principal for app ID %s. Exiting.", app_id_to_sync
             )
             return
 
-        job_id = await get_synchronization_job_id(graph_client, service_principal_id)
         if not job_id:
             logger.error(
-                f"Could not find synchronization job for service principal ID {service_principal_id}. Exiting."
+                "Could not find synchronization job for service principal ID %s. Exiting.",
+                service_principal_id,
             )
             return
 
@@ -201,17 +700,22 @@ async def main():
         logger.info("SCIM provisioning process completed successfully.")
 
     except Exception as e:
-        logger.error(f"An error occurred during the SCIM provisioning process: {e}")
+        # A ResourceNotFound here usually means the cached IDs went stale
+        # (e.g. the enterprise app was recreated); drop them for the next run.
+        if app_id_to_sync:
+            _invalidate_if_resource_not_found(app_id_to_sync, e)
+        logger.error("An error occurred during the SCIM provisioning process: %s", e)
     finally:
         if graph_client:
-            # No explicit close/dispose method in msgraph-sdk-python v1 for GraphServiceClient
-            # Connections are managed by the underlying HTTP client (e.g., httpx)
-            logger.info("Graph client does not require explicit closing.")
+            # Connections are managed by the shared HTTP client, which is closed
+            # once at process shutdown by cli_entry_point.
+            logger.info("Graph client cleanup deferred to process shutdown.")
 
 
 # Optional: Functions for provisionOnDemand (as requested in prompt)
 # These are not part of the main workflow but can be used for targeted provisioning.
 
+@_retry_on_throttle
 async def get_assigned_groups(graph_client: GraphServiceClient, service_principal_id: str) -> list[dict[str, str | None]]:
     """
     Retrieves IDs and display names of groups assigned to the enterprise application.
@@ -224,80 +728,413 @@ async def get_assigned_groups(graph_client: GraphServiceClient, service_principa
         list[dict[str, str | None]]: A list of dictionaries, where each dictionary
                                      contains 'id' and 'displayName' of a group.
     """
-    logger.info(f"Retrieving assigned groups for service principal ID: {service_principal_id}")
-    groups_info: list[dict[str, str | None]] = []
+    logger.info("Retrieving assigned groups for service principal ID: %s", service_principal_id)
     try:
-        def _request_configurator(request_config):
-            request_config.query_parameters.filter = "principalType eq 'Group'"
-            # Select principalId (group id) and principalDisplayName (group name)
-            request_config.query_parameters.select = ["principalId", "principalDisplayName"]
-
-        assignments = await graph_client.service_principals.by_service_principal_id(service_principal_id).app_role_assigned_to.get(
-            request_configuration=_request_configurator
+        assigned_to_builder = graph_client.service_principals.by_service_principal_id(
+            service_principal_id
+        ).app_role_assigned_to
+        assignments = await assigned_to_builder.get(
+            request_configuration=_ASSIGNED_GROUPS_CONFIG
         )
-        if assignments and assignments.value:
-            for assignment in assignments.value:
-                if assignment.principal_id:
-                    group_id = assignment.principal_id
-                    # principal_display_name might be None if not available for some reason
-                    group_display_name = getattr(assignment, 'principal_display_name', None)
-                    groups_info.append({"id": group_id, "displayName": group_display_name})
-                    logger.info(f"Found assigned group: ID '{group_id}', Name: '{group_display_name or 'N/A'}'")
+        # The server-side $count lets zero-assignment apps return before any
+        # page iteration happens.
+        if assignments is not None and getattr(assignments, "odata_count", None) == 0:
+            logger.info("No groups found assigned to service principal ID: %s", service_principal_id)
+            return []
+        # A comprehension keeps the extraction in C-level list building instead
+        # of a per-assignment append loop; principal_display_name may be None.
+        # Follow @odata.nextLink so assignments beyond the first page are not
+        # silently dropped.
+        groups_info: list[dict[str, str | None]] = []
+        while assignments:
+            groups_info.extend(
+                {"id": assignment.principal_id,
+                 "displayName": getattr(assignment, 'principal_display_name', None)}
+                for assignment in (assignments.value or [])
+                if assignment.principal_id
+            )
+            next_link = getattr(assignments, "odata_next_link", None)
+            if not next_link:
+                break
+            assignments = await assigned_to_builder.with_url(next_link).get(
+                request_configuration=_ASSIGNED_GROUPS_CONFIG
+            )
+        if groups_info:
+            logger.info("Found %d assigned group(s) for service principal ID: %s", len(groups_info), service_principal_id)
+            if logger.isEnabledFor(logging.DEBUG):
+                for group_info in groups_info:
+                    logger.debug("Found assigned group: ID '%s', Name: '%s'", group_info["id"], group_info["displayName"] or 'N/A')
         else:
-            logger.info(f"No groups found assigned to service principal ID: {service_principal_id}")
+            logger.info("No groups found assigned to service principal ID: %s", service_principal_id)
         return groups_info
     except ODataError as o_data_error:
-        logger.error(f"OData error retrieving assigned groups for SP ID {service_principal_id}: {o_data_error.error.message}")
+        logger.error("OData error retrieving assigned groups for SP ID %s: %s", service_principal_id, o_data_error.error.message)
         raise
     except Exception as e:
-        logger.error(f"Error retrieving assigned groups for SP ID {service_principal_id}: {e}")
+        logger.error("Error retrieving assigned groups for SP ID %s: %s", service_principal_id, e)
         raise
 
 
-async def get_group_members(graph_client: GraphServiceClient, group_id: str) -> list[str]:
+async def get_group_members(graph_client: GraphServiceClient, group_id: str) -> AsyncIterator[str]:
     """
-    Retrieves user IDs of members in a specific group.
-    Logs user display name and UPN for better traceability.
+    Streams user IDs of members in a specific group, one Graph page at a time.
+
+    Membership is resolved through /transitiveMembers/microsoft.graph.user, so
+    users nested inside sub-groups are included and non-user principals are
+    filtered server-side. Member IDs are yielded as each page arrives
+    (following @odata.nextLink) instead of materializing the full member list,
+    so consumers can start provisioning before paging completes and peak
+    memory stays bounded by the page size even for very large groups.
 
     Args:
         graph_client: The Microsoft Graph client.
         group_id: The ID of the group.
 
-    Returns:
-        list[str]: A list of user IDs.
+    Yields:
+        str: The ID of each member of the group.
     """
-    logger.info(f"Retrieving members for group ID: {group_id}")
-    user_ids: list[str] = []
+    logger.info("Retrieving members for group ID: %s", group_id)
     try:
-        def _request_configurator(request_config):
-            # Select user ID, displayName, and userPrincipalName
-            request_config.query_parameters.select = ["id", "displayName", "userPrincipalName", "userType"]
-            # Potentially filter for only User object types if /members returns other types
-            # request_config.query_parameters.filter = "microsoft.graph.user" # OData cast
-
-        members = await graph_client.groups.by_group_id(group_id).members.get(
-             request_configuration=_request_configurator
+        # The extra identity fields are purely diagnostic, so skip them (and
+        # their bytes on the wire) unless DEBUG logging is enabled.
+        verbose = logger.isEnabledFor(logging.DEBUG)
+        request_configuration = _GROUP_MEMBERS_CONFIG_VERBOSE if verbose else _GROUP_MEMBERS_CONFIG
+
+        members_builder = graph_client.groups.by_group_id(group_id).transitive_members.graph_user
+        # The generator cannot be wrapped by _retry_on_throttle as a whole, so
+        # retry each page fetch individually instead.
+        page = await _call_with_throttle_retry(
+            lambda: members_builder.get(request_configuration=request_configuration),
+            "get_group_members",
         )
-        if members and members.value:
-            for member in members.value:
-                # Ensure the member is a user and has an ID
-                # Check '@odata.type' if more filtering is needed, e.g. member.odata_type == "#microsoft.graph.user"
-                if member.id:
-                    user_ids.append(member.id)
-                    user_display_name = getattr(member, 'display_name', 'N/A')
-                    user_principal_name = getattr(member, 'user_principal_name', 'N/A')
-                    user_type = getattr(member, 'user_type', 'N/A') # Guest/Member
-                    logger.info(f"Found user in group {group_id}: ID '{member.id}', Name: '{user_display_name}', UPN: '{user_principal_name}', UserType: '{user_type}'")
+        member_count = 0
+        while page:
+            if page.value:
+                for member in page.value:
+                    # The microsoft.graph.user cast already filtered to users
+                    # server-side; only a missing ID needs skipping here.
+                    if member.id:
+                        member_count += 1
+                        if verbose:
+                            user_display_name = getattr(member, 'display_name', 'N/A')
+                            user_principal_name = getattr(member, 'user_principal_name', 'N/A')
+                            user_type = getattr(member, 'user_type', 'N/A') # Guest/Member
+                            logger.debug("Found user in group %s: ID '%s', Name: '%s', UPN: '%s', UserType: '%s'", group_id, member.id, user_display_name, user_principal_name, user_type)
+                        yield member.id
+            next_link = getattr(page, "odata_next_link", None)
+            if not next_link:
+                break
+            # Follow @odata.nextLink to stream the next page
+            page = await _call_with_throttle_retry(
+                lambda: members_builder.with_url(next_link).get(
+                    request_configuration=request_configuration
+                ),
+                "get_group_members (next page)",
+            )
+        if member_count:
+            logger.info("Found %s user(s) in group ID: %s", member_count, group_id)
         else:
-            logger.info(f"No members found in group ID: {group_id}")
-        return user_ids
+            logger.info("No members found in group ID: %s", group_id)
+    except ODataError as o_data_error:
+        logger.error("OData error retrieving members for group %s: %s", group_id, o_data_error.error.message)
+        raise
+    except Exception as e:
+        logger.error("Error retrieving members for group %s: %s", group_id, e)
+        raise
+
+@_retry_on_throttle
+async def get_recently_provisioned_user_ids(
+    graph_client: GraphServiceClient, job_id: str, since: datetime
+) -> set[str]:
+    """
+    Returns the directory IDs of users the given synchronization job provisioned
+    successfully after `since`, read from the provisioning audit log. Used to
+    skip users already in a fresh provisioned state on repeat runs.
+
+    Args:
+        graph_client: The Microsoft Graph client.
+        job_id: The ID of the synchronization job.
+        since: Only provisioning events at or after this time count as fresh.
+
+    Returns:
+        set[str]: Source (directory) user IDs with a recent successful event.
+    """
+    cutoff = since.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    config = RequestConfiguration(
+        query_parameters=ProvisioningRequestBuilder.ProvisioningRequestBuilderGetQueryParameters(
+            filter=(
+                f"jobId eq '{job_id}' and statusInfo/status eq 'success' "
+                f"and activityDateTime ge {cutoff}"
+            ),
+            top=999,
+        )
+    )
+    provisioning_builder = graph_client.audit_logs.provisioning
+    recently_provisioned: set[str] = set()
+    page = await provisioning_builder.get(request_configuration=config)
+    while page:
+        for summary in page.value or []:
+            source_identity = getattr(summary, "source_identity", None)
+            if source_identity and source_identity.id:
+                recently_provisioned.add(source_identity.id)
+        next_link = getattr(page, "odata_next_link", None)
+        if not next_link:
+            break
+        page = await provisioning_builder.with_url(next_link).get(
+            request_configuration=config
+        )
+    logger.info(
+        "Found %d user(s) successfully provisioned since %s for job ID: %s",
+        len(recently_provisioned), cutoff, job_id,
+    )
+    return recently_provisioned
+
+
+def _load_delta_links() -> dict[str, dict]:
+    """
+    Loads the persisted delta link store from DELTA_LINK_STORE_PATH. Each entry
+    maps a group ID to {"link": deltaLink, "anchored_at": epoch seconds}; the
+    anchor time drives the periodic full resync (DELTA_FULL_RESYNC_HOURS).
+
+    Returns:
+        dict[str, dict]: The stored delta link entries, or an empty dict when
+                         the store is missing or unreadable.
+    """
+    try:
+        with open(DELTA_LINK_STORE_PATH, "rb") as store:
+            links = orjson.loads(store.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, orjson.JSONDecodeError) as e:
+        logger.warning("Could not read delta link store %s: %s", DELTA_LINK_STORE_PATH, e)
+        return {}
+    if not isinstance(links, dict):
+        return {}
+    # Stores written before anchor times existed held bare link strings; treat
+    # those as anchored at epoch 0 so the age check replaces them immediately.
+    return {
+        group_id: entry if isinstance(entry, dict) else {"link": entry, "anchored_at": 0.0}
+        for group_id, entry in links.items()
+        if entry
+    }
+
+
+def _save_delta_links(links: dict[str, dict]) -> None:
+    """
+    Persists the group-ID -> deltaLink mapping to DELTA_LINK_STORE_PATH.
+    Failures are logged but never fatal: the next run simply falls back to a
+    full membership sync.
+
+    Args:
+        links: The delta links to persist.
+    """
+    try:
+        with open(DELTA_LINK_STORE_PATH, "wb") as store:
+            store.write(orjson.dumps(links))
+    except OSError as e:
+        logger.warning("Could not write delta link store %s: %s", DELTA_LINK_STORE_PATH, e)
+
+
+@_retry_on_throttle
+async def get_latest_group_delta_link(graph_client: GraphServiceClient, group_id: str) -> str | None:
+    """
+    Obtains a deltaLink anchored at "now" for a group's membership, without
+    enumerating any members ($deltaToken=latest). Call this alongside a full
+    membership sync so the next run can use the delta fast path.
+
+    Args:
+        graph_client: The Microsoft Graph client.
+        group_id: The ID of the group.
+
+    Returns:
+        str | None: The deltaLink to persist, or None when Graph returned none.
+    """
+    url = _GROUP_DELTA_LATEST_URL.format(group_id=group_id)
+    response = await graph_client.groups.delta.with_url(url).get()
+    return getattr(response, "odata_delta_link", None)
+
+
+@_retry_on_throttle
+async def get_latest_group_delta_links_batch(
+    graph_client: GraphServiceClient, group_ids: list[str]
+) -> dict[str, str | None]:
+    """
+    Anchors "latest" deltaLinks for several groups using Microsoft Graph JSON
+    batching, collapsing one $deltaToken=latest GET per group into one $batch
+    POST per GRAPH_BATCH_SIZE groups. Used on cold runs, where every assigned
+    group needs a link anchored for the next run's delta fast path.
+
+    Args:
+        graph_client: The Microsoft Graph client.
+        group_ids: The IDs of the groups to anchor deltaLinks for.
+
+    Returns:
+        dict[str, str | None]: The deltaLink per group ID; None for groups
+                               whose sub-request failed (best effort).
+    """
+    from msgraph_core.requests.batch_request_content import BatchRequestContent
+
+    links: dict[str, str | None] = {group_id: None for group_id in group_ids}
+    for chunk in _chunked(group_ids, GRAPH_BATCH_SIZE):
+        batch_content = BatchRequestContent()
+        for group_id in chunk:
+            url = _GROUP_DELTA_LATEST_URL.format(group_id=group_id)
+            request_info = graph_client.groups.delta.with_url(url).to_get_request_information()
+            batch_content.add_request_information(request_info, request_id=group_id)
+        response = await graph_client.batch.post(batch_content)
+        responses = getattr(response, "responses", None) or {}
+        for group_id in chunk:
+            response_item = responses.get(group_id)
+            status = getattr(response_item, "status", None)
+            body = getattr(response_item, "body", None)
+            if not isinstance(status, int) or not (200 <= status < 300) or body is None:
+                logger.debug("No delta link obtained for group %s via $batch (status %s).", group_id, status)
+                continue
+            try:
+                payload = orjson.loads(body.getvalue())
+            except orjson.JSONDecodeError:
+                logger.debug("Could not parse delta response body for group %s.", group_id)
+                continue
+            links[group_id] = payload.get("@odata.deltaLink")
+    return links
+
+
+async def get_changed_group_member_ids(
+    graph_client: GraphServiceClient, group_id: str, delta_link: str
+) -> tuple[list[str] | None, str | None]:
+    """
+    Retrieves only the members added to a group since the given deltaLink,
+    following @odata.nextLink pages until the terminal @odata.deltaLink.
+
+    Graph has no /groups/{id}/members/delta endpoint, so this uses the
+    /groups/delta form: each returned group object carries a "members@delta"
+    collection in its additional data, with removed members tagged "@removed"
+    (removals need no provisioning work and are skipped). Delta tracks direct
+    membership only; changes nested inside sub-groups surface when their own
+    group is assigned or on the periodic full resync that the orchestrator
+    forces once a link is older than DELTA_FULL_RESYNC_HOURS.
+
+    Args:
+        graph_client: The Microsoft Graph client.
+        group_id: The ID of the group (for log messages).
+        delta_link: The deltaLink persisted by a previous run.
+
+    Returns:
+        tuple[list[str] | None, str | None]: The (added member IDs, new deltaLink)
+            pair. The ID list is None when the deltaLink has expired (HTTP 410
+            Gone) and the caller must fall back to a full membership sync.
+    """
+    logger.info("Fetching membership delta for group ID: %s", group_id)
+    added_ids: list[str] = []
+    new_delta_link: str | None = None
+    delta_builder = graph_client.groups.delta
+    next_url: str | None = delta_link
+    try:
+        while next_url:
+            page = await _call_with_throttle_retry(
+                lambda: delta_builder.with_url(next_url).get(),
+                "get_changed_group_member_ids",
+            )
+            for group in (page.value if page and page.value else []):
+                member_entries = (group.additional_data or {}).get("members@delta") or []
+                for entry in member_entries:
+                    if not isinstance(entry, dict) or not entry.get("id"):
+                        continue
+                    if "@removed" in entry:
+                        continue
+                    # members@delta is heterogeneous: an added nested group
+                    # arrives as #microsoft.graph.group and must not be
+                    # provisioned as a user.
+                    if entry.get("@odata.type") != "#microsoft.graph.user":
+                        continue
+                    added_ids.append(entry["id"])
+            next_url = getattr(page, "odata_next_link", None)
+            new_delta_link = getattr(page, "odata_delta_link", None) or new_delta_link
+    except ODataError as o_data_error:
+        if getattr(o_data_error, "response_status_code", None) == 410:
+            # The deltaLink has expired; the caller must do a full resync.
+            logger.info("Delta link for group %s expired (410 Gone); full resync required.", group_id)
+            return None, None
+        logger.error("OData error fetching membership delta for group %s: %s", group_id, o_data_error.error.message)
+        raise
+    except Exception as e:
+        logger.error("Error fetching membership delta for group %s: %s", group_id, e)
+        raise
+    logger.info("Membership delta for group %s: %d added member(s).", group_id, len(added_ids))
+    return added_ids, new_delta_link
+
+
+@_retry_on_throttle
+async def get_group_members_bulk(
+    graph_client: GraphServiceClient, group_infos: list[dict[str, str | None]]
+) -> dict[str, list[str] | None]:
+    """
+    Fetches the members of several groups in a single Graph call using
+    $expand=transitiveMembers($select=id), collapsing one round-trip per group
+    into one round-trip per GROUPS_FILTER_CHUNK_SIZE groups while resolving
+    nested group membership server-side.
+
+    Graph caps expanded collections at GRAPH_EXPAND_MEMBER_LIMIT items, so a
+    group whose expansion hits the cap (or that is missing from the response)
+    is reported as None and must be re-read with the paged get_group_members.
+
+    Args:
+        graph_client: The Microsoft Graph client.
+        group_infos: At most GROUPS_FILTER_CHUNK_SIZE group info dictionaries
+                     (as returned by get_assigned_groups).
+
+    Returns:
+        dict[str, list[str] | None]: Member IDs keyed by group ID, or None for
+                                     groups needing a paged fallback fetch.
+    """
+    group_ids = [group_info["id"] for group_info in group_infos]
+    logger.info("Bulk-fetching members for %d group(s) via $expand.", len(group_ids))
+    id_filter = ",".join(f"'{group_id}'" for group_id in group_ids)
+    # The `in` operator is an advanced query, so it needs $count=true and the
+    # ConsistencyLevel: eventual header.
+    config = RequestConfiguration(
+        headers=HeadersCollection(),
+        query_parameters=GroupsRequestBuilder.GroupsRequestBuilderGetQueryParameters(
+            filter=f"id in ({id_filter})",
+            select=["id"],
+            expand=["transitiveMembers($select=id)"],
+            count=True,
+        ),
+    )
+    config.headers.add("ConsistencyLevel", "eventual")
+
+    try:
+        response = await graph_client.groups.get(request_configuration=config)
     except ODataError as o_data_error:
-        logger.error(f"OData error retrieving members for group {group_id}: {o_data_error.error.message}")
+        logger.error("OData error bulk-fetching group members: %s", o_data_error.error.message)
         raise
     except Exception as e:
-        logger.error(f"Error retrieving members for group {group_id}: {e}")
+        logger.error("Error bulk-fetching group members: %s", e)
         raise
 
+    # Groups absent from the response (deleted, or filtered out) fall back too.
+    members_by_group: dict[str, list[str] | None] = {group_id: None for group_id in group_ids}
+    for group in (response.value if response and response.value else []):
+        if not group.id:
+            continue
+        # transitiveMembers is a heterogeneous directoryObject collection and
+        # $expand cannot apply the microsoft.graph.user cast the paged path
+        # uses, so nested groups/devices must be filtered out here — they would
+        # otherwise be provisioned as users and fail every sub-request.
+        expanded = group.transitive_members or []
+        members = [member.id for member in expanded if isinstance(member, User) and member.id]
+        if len(expanded) >= GRAPH_EXPAND_MEMBER_LIMIT:
+            # Possibly truncated by the expand cap; re-read with paging.
+            logger.debug(
+                "Group %s hit the %d-member expand cap; deferring to paged fetch.",
+                group.id, GRAPH_EXPAND_MEMBER_LIMIT,
+            )
+            continue
+        members_by_group[group.id] = members
+    return members_by_group
+
+
+@_retry_on_throttle
 async def provision_user_on_demand(
     graph_client: GraphServiceClient,
     service_principal_id: str,
@@ -318,12 +1155,11 @@ async def provision_user_on_demand(
         user_id: The ID of the user to provision.
     """
     logger.info(
-        f"Attempting to trigger provisionOnDemand: User ID '{user_id}' (Object Type: 'User') "
-        f"for Job ID '{job_id}' on Service Principal ID '{service_principal_id}'."
+        "Attempting to trigger provisionOnDemand: User ID '%s' (Object Type: 'User') "
+        "for Job ID '%s' on Service Principal ID '%s'.",
+        user_id, job_id, service_principal_id,
     )
 
-    from msgraph.generated.models.synchronization_job_subject import SynchronizationJobSubject
-
     # Create the subject for the on-demand provisioning request
     # The objectTypeName should match the type configured in the sync schema (e.g., "User", "Group")
     subject = SynchronizationJobSubject(
@@ -338,35 +1174,172 @@ async def provision_user_on_demand(
         ).synchronization.jobs.by_synchronization_job_id(
             job_id
         ).provision_on_demand.post(body=subject)
-        logger.info(f"Successfully triggered provisionOnDemand for user ID: {user_id} via job ID: {job_id}")
+        logger.info("Successfully triggered provisionOnDemand for user ID: %s via job ID: %s", user_id, job_id)
     except ODataError as o_data_error:
         logger.error(
-            f"OData error during provisionOnDemand for user {user_id} (Job ID: {job_id}): {o_data_error.error.message}"
+            "OData error during provisionOnDemand for user %s (Job ID: %s): %s",
+            user_id, job_id, o_data_error.error.message,
         )
         # Log more details from o_data_error if available and helpful
         if o_data_error.error and o_data_error.error.details:
             for detail in o_data_error.error.details:
-                logger.error(f"  Detail: Code: {detail.code}, Message: {detail.message}, Target: {detail.target}")
+                logger.error("  Detail: Code: %s, Message: %s, Target: %s", detail.code, detail.message, detail.target)
         raise
     except Exception as e:
-        logger.error(f"Error during provisionOnDemand for user {user_id} (Job ID: {job_id}): {e}")
+        logger.error("Error during provisionOnDemand for user %s (Job ID: %s): %s", user_id, job_id, e)
         raise
 
+def _retry_after_seconds(response, request_ids: list[str]) -> float:
+    """
+    Extracts the largest Retry-After value (in seconds) from the given throttled
+    sub-responses of a $batch response, falling back to a default when absent.
+
+    Args:
+        response: The BatchResponseContent returned by graph_client.batch.post.
+        request_ids: The sub-request IDs that were throttled.
+
+    Returns:
+        float: The number of seconds to wait before retrying.
+    """
+    retry_after = BATCH_DEFAULT_RETRY_AFTER_SECONDS
+    responses = getattr(response, "responses", None) or {}
+    for request_id in request_ids:
+        response_item = responses.get(request_id)
+        headers = getattr(response_item, "headers", None) or {}
+        header_value = headers.get("Retry-After") or headers.get("retry-after")
+        if header_value:
+            try:
+                retry_after = max(retry_after, float(header_value))
+            except (TypeError, ValueError):
+                logger.warning("Could not parse Retry-After header value: %r", header_value)
+    return retry_after
+
+
+async def provision_users_on_demand_batch(
+    graph_client: GraphServiceClient,
+    service_principal_id: str,
+    job_id: str,
+    user_ids: list[str],
+    provision_on_demand_builder=None,
+) -> int:
+    """
+    Triggers on-demand provisioning for many users using Microsoft Graph JSON batching.
+
+    Instead of one HTTP round-trip per user, sub-requests are grouped into $batch
+    POSTs of at most GRAPH_BATCH_SIZE (20) provisionOnDemand calls each, which
+    drastically reduces HTTP overhead and Graph throttling pressure for large groups.
+    Throttled sub-requests (HTTP 429/503) are retried up to BATCH_MAX_RETRIES times,
+    honouring the Retry-After header when present.
+
+    Args:
+        graph_client: The Microsoft Graph client.
+        service_principal_id: The object ID of the service principal.
+        job_id: The ID of the synchronization job.
+        user_ids: The IDs of the users to provision.
+        provision_on_demand_builder: The pre-resolved provisionOnDemand request
+                                     builder; resolved from the IDs when omitted.
+                                     Callers issuing many batches should resolve
+                                     it once and pass it in, since each chain
+                                     walk allocates several intermediate
+                                     request-builder objects.
+
+    Returns:
+        int: The number of users whose provisioning was successfully initiated.
+    """
+    from msgraph_core.requests.batch_request_content import BatchRequestContent
+
+    logger.info(
+        "Provisioning %d user(s) on demand via $batch (Job ID '%s', Service Principal ID '%s').",
+        len(user_ids), job_id, service_principal_id,
+    )
+    if provision_on_demand_builder is None:
+        provision_on_demand_builder = graph_client.service_principals.by_service_principal_id(
+            service_principal_id
+        ).synchronization.jobs.by_synchronization_job_id(job_id).provision_on_demand
+
+    succeeded = 0
+    for chunk in _chunked(user_ids, GRAPH_BATCH_SIZE):
+        # Map sub-request IDs to user IDs so per-sub-request outcomes can be attributed.
+        remaining = {str(index): user_id for index, user_id in enumerate(chunk)}
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            batch_content = BatchRequestContent()
+            for request_id, user_id in remaining.items():
+                subject = SynchronizationJobSubject(object_id=user_id, object_type_name="User")
+                request_info = provision_on_demand_builder.to_post_request_information(body=subject)
+                batch_content.add_request_information(request_info, request_id=request_id)
+
+            try:
+                response = await graph_client.batch.post(batch_content)
+            except ODataError as o_data_error:
+                logger.error("OData error submitting provisionOnDemand $batch: %s", o_data_error.error.message)
+                raise
+            except Exception as e:
+                logger.error("Error submitting provisionOnDemand $batch: %s", e)
+                raise
+
+            status_codes = response.get_response_status_codes() if response else {}
+            throttled: dict[str, str] = {}
+            for request_id, user_id in remaining.items():
+                status = status_codes.get(request_id)
+                if status is not None and 200 <= status < 300:
+                    succeeded += 1
+                    logger.info("Successfully triggered provisionOnDemand for user ID: %s via job ID: %s", user_id, job_id)
+                elif status in (429, 503):
+                    throttled[request_id] = user_id
+                elif status in (401, 403):
+                    # Authorization failures apply to every remaining call, so
+                    # surface them instead of logging and moving on — the
+                    # orchestrator aborts the run on these.
+                    logger.error(
+                        "provisionOnDemand sub-request for user ID '%s' (Job ID: %s) failed with HTTP %s; aborting.",
+                        user_id, job_id, status,
+                    )
+                    auth_error = ODataError(
+                        error=MainError(message=f"provisionOnDemand denied with HTTP {status}")
+                    )
+                    auth_error.response_status_code = status
+                    raise auth_error
+                else:
+                    logger.error(
+                        "provisionOnDemand sub-request failed for user ID '%s' (Job ID: %s): HTTP status %s",
+                        user_id, job_id, status,
+                    )
+
+            if not throttled:
+                break
+            remaining = throttled
+            if attempt < BATCH_MAX_RETRIES:
+                wait_seconds = _retry_after_seconds(response, list(remaining))
+                logger.warning(
+                    "%d provisionOnDemand sub-request(s) throttled; retrying in %.1fs (attempt %d/%d).",
+                    len(remaining), wait_seconds, attempt + 1, BATCH_MAX_RETRIES,
+                )
+                await asyncio.sleep(wait_seconds)
+            else:
+                for user_id in remaining.values():
+                    logger.error(
+                        "Giving up on provisionOnDemand for user ID '%s' after %d throttled retries (Job ID: %s).",
+                        user_id, BATCH_MAX_RETRIES, job_id,
+                    )
+
+    logger.info("$batch provisioning complete: %s/%s user(s) initiated successfully.", succeeded, len(user_ids))
+    return succeeded
+
+
 async def provision_all_users_on_demand_in_app(graph_client: GraphServiceClient, app_id: str):
     """
     Orchestrates on-demand provisioning for all users in all groups assigned to an application.
     This is an example of using the optional functions.
     """
-    logger.info(f"Starting on-demand provisioning for all users in app ID: {app_id}")
+    logger.info("Starting on-demand provisioning for all users in app ID: %s", app_id)
     # Note: app_id is passed directly to this function, no need to getenv here
-    service_principal_id = await get_service_principal_id(graph_client, app_id)
+    service_principal_id, job_id = await resolve_sync_target(graph_client, app_id)
     if not service_principal_id:
-        logger.error(f"Cannot perform on-demand provisioning: Service principal not found for app {app_id}.")
+        logger.error("Cannot perform on-demand provisioning: Service principal not found for app %s.", app_id)
         return
 
-    job_id = await get_synchronization_job_id(graph_client, service_principal_id)
     if not job_id:
-        logger.error(f"Cannot perform on-demand provisioning: Sync job not found for SP {service_principal_id}.")
+        logger.error("Cannot perform on-demand provisioning: Sync job not found for SP %s.", service_principal_id)
         return
 
     # Discover a valid ruleId from the schema (example, might need adjustment)
@@ -385,60 +1358,330 @@ async def provision_all_users_on_demand_in_app(graph_client: GraphServiceClient,
 
     assigned_groups_info = await get_assigned_groups(graph_client, service_principal_id)
     if not assigned_groups_info:
-        logger.info(f"No groups assigned to the application (App ID: {app_id}, SP ID: {service_principal_id}). Nothing to provision on demand.")
+        logger.info("No groups assigned to the application (App ID: %s, SP ID: %s). Nothing to provision on demand.", app_id, service_principal_id)
         return
 
-    logger.info(f"Found {len(assigned_groups_info)} group(s) assigned to App ID '{app_id}' (SP ID: {service_principal_id}) for on-demand provisioning.")
+    logger.info("Found %s group(s) assigned to App ID '%s' (SP ID: %s) for on-demand provisioning.", len(assigned_groups_info), app_id, service_principal_id)
+
+    # Resolve the provisionOnDemand request builder once; walking the builder
+    # chain allocates several intermediate objects, so don't repeat it per batch.
+    provision_on_demand_builder = graph_client.service_principals.by_service_principal_id(
+        service_principal_id
+    ).synchronization.jobs.by_synchronization_job_id(job_id).provision_on_demand
+
+    # Producer/consumer pipeline: producers stream member pages onto a bounded
+    # queue while worker tasks pull user IDs off it and provision them in $batch
+    # chunks, so discovery and provisioning overlap instead of running in phases.
+    # The semaphore keeps member-fetch concurrency bounded to avoid tripping
+    # Graph throttling quotas — do NOT go unbounded here.
+    semaphore = asyncio.Semaphore(GRAPH_CONCURRENCY_LIMIT)
+    queue: asyncio.Queue[str] = asyncio.Queue(maxsize=PROVISION_QUEUE_MAXSIZE)
+    # Users frequently belong to several assigned groups; provisioning them once
+    # is enough, so track IDs already enqueued and skip repeats. The membership
+    # counter tracks the raw (pre-dedupe) total so the run summary can report
+    # how much duplicate work the dedupe avoided.
+    enqueued_user_ids: set[str] = set()
+    total_membership_count = 0
+    # Optionally pre-seed the dedupe set with users the audit log shows were
+    # provisioned successfully within the configured freshness window, so they
+    # are skipped exactly like cross-group duplicates.
+    if RECENT_PROVISION_SKIP_HOURS > 0:
+        try:
+            since = datetime.now(timezone.utc) - timedelta(hours=RECENT_PROVISION_SKIP_HOURS)
+            recently_provisioned = await get_recently_provisioned_user_ids(graph_client, job_id, since)
+        except Exception as e:
+            logger.warning("Could not read provisioning history; not skipping any users. Error: %s", e)
+        else:
+            if recently_provisioned:
+                logger.info(
+                    "Skipping %d user(s) provisioned successfully within the last %.1fh.",
+                    len(recently_provisioned), RECENT_PROVISION_SKIP_HOURS,
+                )
+                enqueued_user_ids |= recently_provisioned
+    # Delta links persisted by previous runs let steady-state re-runs provision
+    # only members added since the last run instead of every member.
+    delta_links = _load_delta_links()
+    links_dirty = False
+    # Age out old links: the delta fast path only sees direct membership
+    # changes, so each group must still get a full transitive resync at least
+    # every DELTA_FULL_RESYNC_HOURS to pick up nested sub-group changes.
+    if DELTA_FULL_RESYNC_HOURS > 0 and delta_links:
+        anchor_cutoff = time.time() - DELTA_FULL_RESYNC_HOURS * 3600
+        stale_group_ids = [
+            group_id for group_id, entry in delta_links.items()
+            if entry.get("anchored_at", 0.0) < anchor_cutoff
+        ]
+        for group_id in stale_group_ids:
+            del delta_links[group_id]
+        if stale_group_ids:
+            links_dirty = True
+            logger.info(
+                "Discarded %d delta link(s) older than %.1fh; those groups get a full resync.",
+                len(stale_group_ids), DELTA_FULL_RESYNC_HOURS,
+            )
+    # First unrecoverable authorization failure (401/403). Once set, producers
+    # stop discovering and workers drain the queue without provisioning, so the
+    # run fails fast instead of burning quota on thousands of doomed calls.
+    fatal_error: list[Exception] = []
+
+    async def _refresh_delta_link(group_id: str):
+        # Best effort: anchor a deltaLink at "now" so the NEXT run can take the
+        # delta fast path. Failure only costs that run a full sync.
+        nonlocal links_dirty
+        try:
+            link = await get_latest_group_delta_link(graph_client, group_id)
+        except Exception as e:
+            logger.debug("Could not obtain delta link for group %s: %s", group_id, e)
+            return
+        if link:
+            delta_links[group_id] = {"link": link, "anchored_at": time.time()}
+            links_dirty = True
 
-    for group_info in assigned_groups_info:
+    async def _produce_group_members(group_info: dict[str, str | None]):
         group_id = group_info["id"]
         group_display_name = group_info["displayName"] or "N/A"
-        logger.info(f"Processing group: ID '{group_id}', Name: '{group_display_name}' for on-demand user provisioning (App ID: {app_id}).")
-
-        user_ids = await get_group_members(graph_client, group_id)
-        if not user_ids:
-            logger.info(f"No user members found in group '{group_display_name}' (ID: {group_id}). Skipping provisioning for this group.")
-            continue
+        logger.info("Processing group: ID '%s', Name: '%s' for on-demand user provisioning (App ID: %s).", group_id, group_display_name, app_id)
+        member_count = 0
+        duplicate_count = 0
+        nonlocal total_membership_count
+        try:
+            async with semaphore:
+                # Anchor the delta link before enumerating so membership changes
+                # made during this run show up in the next run's delta.
+                await _refresh_delta_link(group_id)
+                async for user_id in get_group_members(graph_client, group_id):
+                    if fatal_error:
+                        return
+                    member_count += 1
+                    total_membership_count += 1
+                    if user_id in enqueued_user_ids:
+                        duplicate_count += 1
+                        continue
+                    enqueued_user_ids.add(user_id)
+                    await queue.put(user_id)
+        except Exception as e:
+            # Continue with the other groups rather than aborting the whole run.
+            _invalidate_if_resource_not_found(app_id, e)
+            logger.error("Failed to retrieve members for group '%s' (ID: %s). Error: %s", group_display_name, group_id, e)
+            return
+        if not member_count:
+            logger.info("No user members found in group '%s' (ID: %s). Skipping provisioning for this group.", group_display_name, group_id)
+        elif duplicate_count:
+            logger.info(
+                "Skipped %d of %d user(s) in group '%s' (ID: %s) already enqueued via another assigned group.",
+                duplicate_count, member_count, group_display_name, group_id,
+            )
 
-        logger.info(f"Found {len(user_ids)} user(s) in group '{group_display_name}' (ID: {group_id}). Attempting on-demand provisioning for each.")
-        for user_id in user_ids:
-            logger.info(f"Attempting on-demand provisioning for User ID: {user_id} from group '{group_display_name}' (ID: {group_id}).")
-            try:
-                await provision_user_on_demand(
-                    graph_client,
-                    service_principal_id,
-                    job_id,
-                    user_id,
-                    # rule_id parameter removed as it's not directly used in the SDK call with SynchronizationJobSubject
+    async def _produce_group_chunk(chunk: list[dict[str, str | None]]):
+        # One $expand call covers the whole chunk; groups the bulk fetch could
+        # not fully resolve (expand cap, missing) fall back to paged streaming.
+        nonlocal links_dirty, total_membership_count
+        if fatal_error:
+            return
+        # Anchor deltaLinks for the whole chunk in one $batch POST BEFORE
+        # enumerating, so members added between the anchor and the snapshot
+        # appear in the next run's delta instead of being lost until the link
+        # expires. Groups that end up on the paged fallback drop this anchor;
+        # the fallback anchors its own link before streaming.
+        try:
+            async with semaphore:
+                new_links = await get_latest_group_delta_links_batch(
+                    graph_client, [group_info["id"] for group_info in chunk]
                 )
-                logger.info(f"Successfully initiated on-demand provisioning for User ID: {user_id} from group '{group_display_name}'.")
-            except Exception as e:
-                # Log the specific user_id and group_id where the error occurred
-                logger.error(f"Failed to provision User ID '{user_id}' from group '{group_display_name}' (ID: {group_id}) on demand. Error: {e}")
-                # Optionally, decide whether to continue with other users/groups or stop
-    logger.info(f"Completed on-demand provisioning process for users in App ID: {app_id} (SP ID: {service_principal_id}).")
+        except Exception as e:
+            logger.debug("Could not batch-anchor delta links: %s", e)
+            new_links = {}
+        for group_id, link in new_links.items():
+            if link:
+                delta_links[group_id] = {"link": link, "anchored_at": time.time()}
+                links_dirty = True
 
-async def cli_entry_point():
-    """Determines which workflow to run based on environment variables."""
-    if os.getenv("RUN_ON_DEMAND_PROVISIONING", "false").lower() == "true":
-        logger.info("RUN_ON_DEMAND_PROVISIONING is true, running on-demand sync.")
-        # Get AZURE_APP_ID inside the function where it's needed for this branch
-        app_id_for_demand = os.getenv("AZURE_APP_ID")
-        if not app_id_for_demand:
-            logger.error("AZURE_APP_ID environment variable not set. Cannot run on-demand provisioning.")
+        try:
+            async with semaphore:
+                members_by_group = await get_group_members_bulk(graph_client, chunk)
+        except Exception as e:
+            _invalidate_if_resource_not_found(app_id, e)
+            logger.warning(
+                "Bulk member fetch failed for %d group(s); falling back to per-group fetch. Error: %s",
+                len(chunk), e,
+            )
+            members_by_group = {group_info["id"]: None for group_info in chunk}
+
+        fallback_groups = []
+        for group_info in chunk:
+            members = members_by_group.get(group_info["id"])
+            if members is None:
+                # The paged fallback re-anchors before streaming; keeping the
+                # pre-fetch anchor would claim coverage the snapshot never had.
+                if delta_links.pop(group_info["id"], None) is not None:
+                    links_dirty = True
+                fallback_groups.append(group_info)
+                continue
+            for user_id in members:
+                total_membership_count += 1
+                if user_id in enqueued_user_ids:
+                    continue
+                enqueued_user_ids.add(user_id)
+                await queue.put(user_id)
+        if fallback_groups:
+            await asyncio.gather(
+                *(_produce_group_members(group_info) for group_info in fallback_groups)
+            )
+
+    async def _produce_group_delta(group_info: dict[str, str | None]):
+        # Fast path for groups with a persisted deltaLink: only members added
+        # since the previous run need provisioning.
+        nonlocal links_dirty, total_membership_count
+        if fatal_error:
             return
+        group_id = group_info["id"]
+        group_display_name = group_info["displayName"] or "N/A"
         try:
-            client = await get_graph_client()
-            await provision_all_users_on_demand_in_app(client, app_id_for_demand) # Use local variable
+            async with semaphore:
+                added_ids, new_link = await get_changed_group_member_ids(
+                    graph_client, group_id, delta_links[group_id]["link"]
+                )
         except Exception as e:
-             logger.error(f"An error occurred during the on-demand provisioning process: {e}")
-             # Decide if you want to exit with error code here or just log
-    else:
-        logger.info("Running main synchronization job.")
-        # main() now fetches AZURE_APP_ID internally
-        await main()
+            _invalidate_if_resource_not_found(app_id, e)
+            logger.error(
+                "Failed to fetch membership delta for group '%s' (ID: %s); falling back to full sync. Error: %s",
+                group_display_name, group_id, e,
+            )
+            added_ids, new_link = None, None
+        if added_ids is None:
+            # Expired (410 Gone) or failed: drop the link and do a full sync,
+            # which also re-anchors a fresh deltaLink for the next run.
+            delta_links.pop(group_id, None)
+            links_dirty = True
+            await _produce_group_members(group_info)
+            return
+        if new_link:
+            # Keep the original anchor time: advancing the link must not defer
+            # the periodic full resync.
+            delta_links[group_id] = {
+                "link": new_link,
+                "anchored_at": delta_links[group_id].get("anchored_at", 0.0),
+            }
+            links_dirty = True
+        if added_ids:
+            logger.info(
+                "Delta sync for group '%s' (ID: %s): provisioning %d added member(s).",
+                group_display_name, group_id, len(added_ids),
+            )
+        else:
+            logger.info(
+                "Delta sync for group '%s' (ID: %s): no membership changes since last run.",
+                group_display_name, group_id,
+            )
+        for user_id in added_ids:
+            total_membership_count += 1
+            if user_id in enqueued_user_ids:
+                continue
+            enqueued_user_ids.add(user_id)
+            await queue.put(user_id)
+
+    async def _provision_worker():
+        while True:
+            user_id = await queue.get()
+            # Drain whatever else is already queued, up to one full $batch.
+            batch = [user_id]
+            while len(batch) < GRAPH_BATCH_SIZE:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                # After an authorization failure the queue is drained without
+                # provisioning so queue.join() can complete and the run abort.
+                if not fatal_error:
+                    await provision_users_on_demand_batch(
+                        graph_client, service_principal_id, job_id, batch,
+                        provision_on_demand_builder=provision_on_demand_builder,
+                    )
+            except Exception as e:
+                _invalidate_if_resource_not_found(app_id, e)
+                if _is_auth_failure(e) and not fatal_error:
+                    fatal_error.append(e)
+                    logger.error(
+                        "Authorization failure (HTTP %s) while provisioning; aborting the remaining work.",
+                        e.response_status_code,
+                    )
+                else:
+                    # Per-user failures are already logged inside
+                    # provision_users_on_demand_batch; keep the worker alive.
+                    logger.error("Failed to provision a batch of %s user(s) on demand. Error: %s", len(batch), e)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    # Groups with a persisted deltaLink take the delta fast path; the rest go
+    # through the bulk $expand fetch (which anchors a link for next time).
+    delta_groups = [g for g in assigned_groups_info if g["id"] in delta_links]
+    full_groups = [g for g in assigned_groups_info if g["id"] not in delta_links]
+
+    workers = [asyncio.create_task(_provision_worker()) for _ in range(GRAPH_CONCURRENCY_LIMIT)]
+    try:
+        await asyncio.gather(
+            *(_produce_group_chunk(chunk)
+              for chunk in _chunked(full_groups, GROUPS_FILTER_CHUNK_SIZE)),
+            *(_produce_group_delta(group_info) for group_info in delta_groups),
+        )
+        # Wait for the workers to drain everything the producers enqueued.
+        await queue.join()
+        logger.info(
+            "Enqueued %d unique user(s) from %d group membership(s) (%d duplicate(s) skipped).",
+            len(enqueued_user_ids), total_membership_count,
+            total_membership_count - len(enqueued_user_ids),
+        )
+        if links_dirty:
+            _save_delta_links(delta_links)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    if fatal_error:
+        raise fatal_error[0]
+    logger.info("Completed on-demand provisioning process for users in App ID: %s (SP ID: %s).", app_id, service_principal_id)
+
+async def cli_entry_point():
+    """Determines which workflow to run based on the environment, parsed once."""
+    config = Config.from_env()
+    try:
+        if config.on_demand:
+            logger.info("RUN_ON_DEMAND_PROVISIONING is true, running on-demand sync.")
+            # Fail fast before any authentication work is done.
+            if not config.app_id:
+                logger.error("AZURE_APP_ID environment variable not set. Cannot run on-demand provisioning.")
+                return
+            try:
+                client = await get_graph_client()
+                await provision_all_users_on_demand_in_app(client, config.app_id)
+            except Exception as e:
+                 logger.error("An error occurred during the on-demand provisioning process: %s", e)
+                 # Decide if you want to exit with error code here or just log
+        else:
+            logger.info("Running main synchronization job.")
+            await main(config.app_id)
+    finally:
+        # Release the shared connection pool exactly once per process.
+        await close_graph_client()
+
+def run_entrypoint():
+    """Installs the preferred event loop and runs the CLI entry point.
+
+    Kept as an importable function (rather than inline under the __main__
+    guard) so tests can exercise it without exec()ing the module source.
+    """
+    # Prefer uvloop's libuv-backed event loop for high-concurrency I/O; fall
+    # back silently to the stock loop where it is unavailable (e.g. Windows).
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("Using uvloop event loop policy.")
+    except ImportError:
+        logger.debug("uvloop not available; using the default asyncio event loop.")
+    asyncio.run(cli_entry_point())
+
 
 if __name__ == "__main__":
-    import asyncio
-    # Run the new entry point function
-    asyncio.run(cli_entry_point()) 
\ No newline at end of file
+    run_entrypoint()
\ No newline at end of file
@@ -1,26 +1,19 @@
 import asyncio
 import logging
 import os
-from unittest.mock import AsyncMock, MagicMock, patch
+import time
+from unittest.mock import ANY, DEFAULT, AsyncMock, MagicMock, patch
 
 import pytest
-from azure.identity.aio import DefaultAzureCredential # For async mocking
 from msgraph import GraphServiceClient
 from msgraph.generated.models.service_principal import ServicePrincipal
 from msgraph.generated.models.synchronization_job import SynchronizationJob
 from msgraph.generated.models.app_role_assignment import AppRoleAssignment
 from msgraph.generated.models.user import User
+from msgraph.generated.models.group import Group
 from msgraph.generated.models.o_data_errors.o_data_error import ODataError
 from msgraph.generated.models.o_data_errors.main_error import MainError
 
-# Add src directory to sys.path to allow direct import of scim_syncer
-import sys
-
-# Construct the absolute path to the src directory
-current_dir = os.path.dirname(os.path.abspath(__file__))
-src_path = os.path.join(os.path.dirname(current_dir), "src")
-sys.path.insert(0, src_path)
-
 import scim_syncer # type: ignore
 
 # Test constants
@@ -30,23 +23,80 @@ TEST_JOB_ID = "test-job-id"
 TEST_GROUP_ID_1 = "test-group-id-1"
 TEST_USER_ID_1 = "test-user-id-1"
 
-@pytest.fixture(autouse=True)
-def set_env_vars(monkeypatch):
-    monkeypatch.setenv("AZURE_APP_ID", TEST_APP_ID)
-    # Clear any existing handlers on the root logger to avoid duplicate logs in tests
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-    # Configure logging for tests
-    logging.basicConfig(level=logging.DEBUG, handlers=[logging.StreamHandler(sys.stdout)])
-    # Reload scim_syncer to pick up patched env var if it was loaded at module level
+def _odata_error(message, status=None, headers=None):
+    """Builds an ODataError with an optional HTTP status and response headers."""
+    error = ODataError(error=MainError(message=message))
+    if status is not None:
+        error.response_status_code = status
+    if headers is not None:
+        error.response_headers = headers
+    return error
+
+# Pre-built error instances shared across tests; Kiota model construction is
+# comparatively expensive and the raise-only usage never mutates them.
+_ODATA_ERROR = _odata_error("Test OData Error")
+
+# Pre-built Kiota model instances for success-path responses; the tests only
+# read them, so one copy of each constant payload serves the whole suite.
+_TEST_SP = ServicePrincipal(id=TEST_SP_ID, app_id=TEST_APP_ID)
+_TEST_JOB = SynchronizationJob(id=TEST_JOB_ID)
+_TEST_GROUP_ASSIGNMENT = AppRoleAssignment(
+    principal_id=TEST_GROUP_ID_1, principal_type="Group"
+)
+_TEST_GROUP_ASSIGNMENT.principal_display_name = "Test Group 1 Name"
+_TEST_USER = User(id=TEST_USER_ID_1)
+# odata_type is usually @odata.type in actual responses, but the model property is odata_type
+_TEST_USER.odata_type = "#microsoft.graph.user" # Important for filtering if done in code
+_THROTTLED_429_ERROR = _odata_error("Throttled", 429, {"Retry-After": "2"})
+_THROTTLED_503_ERROR = _odata_error("Throttled", 503)
+_GONE_ERROR = _odata_error("Gone", 410)
+_FORBIDDEN_ERROR = _odata_error("Forbidden", 403)
+
+def _async_iter(items):
+    """Returns an async iterator over `items`, mimicking the get_group_members stream."""
+    async def _gen():
+        for item in items:
+            yield item
+    return _gen()
+
+@pytest.fixture(scope="session", autouse=True)
+def reload_module_once():
+    """Reloads scim_syncer once per session with the test environment applied.
+
+    Reloading per test re-executed the module (and its SDK import graph) for
+    every test; a single session reload plus the cheap per-test state reset in
+    reset_module_state gives the same isolation at a fraction of the cost. The
+    AZURE_APP_ID value never varies across the suite, so it is set (and torn
+    down) once here rather than per test.
+    """
+    mp = pytest.MonkeyPatch()
+    mp.setenv("AZURE_APP_ID", TEST_APP_ID)
     import importlib
     importlib.reload(scim_syncer)
+    # Replace the handlers the module installed on import with a NullHandler,
+    # once for the whole session: caplog captures through its own handler, and
+    # reconfiguring logging per test was pure churn.
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    logging.basicConfig(level=logging.DEBUG, handlers=[logging.NullHandler()])
+    yield
+    mp.undo()
 
-@pytest.fixture
-def mock_graph_service_client():
-    """Provides a mock GraphServiceClient with mocked fluent methods."""
-    mock_client = AsyncMock(spec=GraphServiceClient)
-
+@pytest.fixture(autouse=True)
+def reset_module_state(monkeypatch, tmp_path):
+    # Reset the module-level singletons and caches directly instead of paying
+    # a full module reload per test.
+    scim_syncer._graph_client = None
+    scim_syncer._http_client = None
+    scim_syncer._credential = None
+    scim_syncer._sync_target_cache.clear()
+    # Point the delta link store at a per-test path: the orchestration tests
+    # exercise the real load/save/aging code, which must never read or rewrite
+    # an operator's .scim_delta_links.json in the working directory.
+    monkeypatch.setattr(scim_syncer, "DELTA_LINK_STORE_PATH", str(tmp_path / "delta_links.json"))
+
+def _attach_mock_graph_tree(mock_client):
+    """Attaches fresh fluent-method mocks to a GraphServiceClient mock."""
     # Mock service_principals attribute
     mock_client.service_principals = MagicMock()
 
@@ -71,6 +121,10 @@ def mock_graph_service_client():
     mock_sync_job_item_builder.provision_on_demand = MagicMock(name="ProvisionOnDemandRequestBuilder")
     mock_sync_job_item_builder.provision_on_demand.post = AsyncMock() # async action
 
+    # Mock the batch request builder used for $batch provisioning
+    mock_client.batch = MagicMock(name="BatchRequestBuilder")
+    mock_client.batch.post = AsyncMock() # async action
+
     mock_sp_item_builder.app_role_assigned_to = MagicMock(name="AppRoleAssignedToRequestBuilder")
     mock_sp_item_builder.app_role_assigned_to.get = AsyncMock() # async action
 
@@ -82,15 +136,38 @@ def mock_graph_service_client():
     mock_client.groups.by_group_id.return_value = mock_group_item_builder
 
     # Mock attributes/methods on the GroupItemRequestBuilder
-    mock_group_item_builder.members = MagicMock(name="MembersRequestBuilder")
-    mock_group_item_builder.members.get = AsyncMock() # async action
+    mock_group_item_builder.transitive_members = MagicMock(name="TransitiveMembersRequestBuilder")
+    mock_group_item_builder.transitive_members.graph_user = MagicMock(name="GraphUserRequestBuilder")
+    mock_group_item_builder.transitive_members.graph_user.get = AsyncMock() # async action
 
     return mock_client
 
-@patch("scim_syncer.DefaultAzureCredential", spec=DefaultAzureCredential)
-@patch("scim_syncer.GraphServiceClient", spec=GraphServiceClient)
-@pytest.mark.asyncio
-async def test_get_graph_client_success(MockGraphServiceClient, MockDefaultAzureCredential):
+@pytest.fixture(scope="session")
+def _mock_graph_template():
+    """Creates the spec'd GraphServiceClient mock shell once per session.
+
+    AsyncMock(spec=GraphServiceClient) walks the generated client class via
+    inspect, which is far too expensive to repeat for every test; the fluent
+    sub-mocks attached on top are cheap and rebuilt per test.
+    """
+    return AsyncMock(spec=GraphServiceClient)
+
+@pytest.fixture
+def mock_graph_service_client(_mock_graph_template):
+    """Provides the shared mock GraphServiceClient, fully reset between tests."""
+    _mock_graph_template.reset_mock(return_value=True, side_effect=True)
+    _attach_mock_graph_tree(_mock_graph_template)
+    return _mock_graph_template
+
+@patch("scim_syncer.DefaultAzureCredential")
+@patch("scim_syncer.AzureIdentityAuthenticationProvider")
+@patch("scim_syncer.GraphRequestAdapter")
+@patch("scim_syncer.GraphServiceClient")
+@patch("scim_syncer._get_http_client")
+async def test_get_graph_client_success(
+    mock_get_http_client, MockGraphServiceClient, MockGraphRequestAdapter,
+    MockAuthProvider, MockDefaultAzureCredential
+):
     """Tests successful GraphServiceClient initialization."""
     mock_credential_instance = MockDefaultAzureCredential.return_value
     mock_client_instance = MockGraphServiceClient.return_value
@@ -98,25 +175,78 @@ async def test_get_graph_client_success(MockGraphServiceClient, MockDefaultAzure
     client = await scim_syncer.get_graph_client()
 
     MockDefaultAzureCredential.assert_called_once()
+    MockAuthProvider.assert_called_once_with(
+        mock_credential_instance, scopes=["https://graph.microsoft.com/.default"]
+    )
+    MockGraphRequestAdapter.assert_called_once_with(
+        MockAuthProvider.return_value, client=mock_get_http_client.return_value
+    )
     MockGraphServiceClient.assert_called_once_with(
-        credentials=mock_credential_instance, scopes=["https://graph.microsoft.com/.default"]
+        request_adapter=MockGraphRequestAdapter.return_value
     )
     assert client == mock_client_instance
 
+@patch("scim_syncer.DefaultAzureCredential")
+@patch("scim_syncer.AzureIdentityAuthenticationProvider")
+@patch("scim_syncer.GraphRequestAdapter")
+@patch("scim_syncer.GraphServiceClient")
+@patch("scim_syncer._get_http_client")
+async def test_get_graph_client_is_cached(
+    mock_get_http_client, MockGraphServiceClient, MockGraphRequestAdapter,
+    MockAuthProvider, MockDefaultAzureCredential
+):
+    """Tests that repeated calls reuse the cached GraphServiceClient."""
+    first = await scim_syncer.get_graph_client()
+    second = await scim_syncer.get_graph_client()
+
+    assert first is second
+    MockGraphServiceClient.assert_called_once()
+    MockDefaultAzureCredential.assert_called_once()
+
+@patch("scim_syncer.DefaultAzureCredential")
+@patch("scim_syncer.AzureIdentityAuthenticationProvider")
+@patch("scim_syncer.GraphRequestAdapter")
+@patch("scim_syncer.GraphServiceClient")
+@patch("scim_syncer._get_http_client")
+async def test_close_graph_client_releases_credential(
+    mock_get_http_client, MockGraphServiceClient, MockGraphRequestAdapter,
+    MockAuthProvider, MockDefaultAzureCredential
+):
+    """Tests that close_graph_client closes the async credential exactly once."""
+    credential_instance = MockDefaultAzureCredential.return_value
+    # close_graph_client awaits credential.close(); without a spec'd mock the
+    # awaitable leaf must be armed explicitly.
+    credential_instance.close = AsyncMock()
+    await scim_syncer.get_graph_client()
+
+    await scim_syncer.close_graph_client()
+
+    credential_instance.close.assert_awaited_once()
+
+    # A subsequent call rebuilds both the client and the credential.
+    await scim_syncer.get_graph_client()
+    assert MockDefaultAzureCredential.call_count == 2
+
+def test_orjson_serialization_roundtrip():
+    """Tests that the orjson-backed factories serialize and parse JSON correctly."""
+    writer = scim_syncer._OrjsonSerializationWriterFactory().get_serialization_writer("application/json")
+    writer.write_str_value("displayName", "Test User")
+    content = writer.get_serialized_content()
+
+    node = scim_syncer._OrjsonParseNodeFactory().get_root_parse_node("application/json", content)
+    assert node.get_child_node("displayName").get_str_value() == "Test User"
+
 @patch("scim_syncer.DefaultAzureCredential", side_effect=Exception("Auth error"))
-@pytest.mark.asyncio
 async def test_get_graph_client_failure(MockDefaultAzureCredential):
     """Tests GraphServiceClient initialization failure."""
     with pytest.raises(Exception, match="Auth error"):
         await scim_syncer.get_graph_client()
     MockDefaultAzureCredential.assert_called_once()
 
-@pytest.mark.asyncio
 async def test_get_service_principal_id_success(mock_graph_service_client):
     """Tests successful retrieval of service principal ID."""
-    sp = ServicePrincipal(id=TEST_SP_ID, app_id=TEST_APP_ID)
     mock_response = MagicMock()
-    mock_response.value = [sp]
+    mock_response.value = [_TEST_SP]
     mock_graph_service_client.service_principals.get.return_value = mock_response
 
     sp_id = await scim_syncer.get_service_principal_id(mock_graph_service_client, TEST_APP_ID)
@@ -136,32 +266,76 @@ async def test_get_service_principal_id_success(mock_graph_service_client):
 
     assert sp_id == TEST_SP_ID
 
-@pytest.mark.asyncio
-async def test_get_service_principal_id_not_found(mock_graph_service_client):
-    """Tests service principal not found."""
+_EMPTY_RESPONSE_CASES = [
+    pytest.param(
+        lambda client: client.service_principals.get,
+        lambda client: scim_syncer.get_service_principal_id(client, TEST_APP_ID),
+        None,
+        id="get_service_principal_id",
+    ),
+    pytest.param(
+        lambda client: client.service_principals.by_service_principal_id.return_value.synchronization.jobs.get,
+        lambda client: scim_syncer.get_synchronization_job_id(client, TEST_SP_ID),
+        None,
+        id="get_synchronization_job_id",
+    ),
+    pytest.param(
+        lambda client: client.service_principals.by_service_principal_id.return_value.app_role_assigned_to.get,
+        lambda client: scim_syncer.get_assigned_groups(client, TEST_SP_ID),
+        [],
+        id="get_assigned_groups",
+    ),
+]
+
+@pytest.mark.parametrize("get_graph_call,invoke,expected", _EMPTY_RESPONSE_CASES)
+async def test_sync_helpers_empty_response(mock_graph_service_client, get_graph_call, invoke, expected):
+    """Tests that an empty Graph response yields no target from each sync helper."""
     mock_response = MagicMock()
     mock_response.value = []
-    mock_graph_service_client.service_principals.get.return_value = mock_response
-
-    sp_id = await scim_syncer.get_service_principal_id(mock_graph_service_client, TEST_APP_ID)
-    assert sp_id is None
-
-@pytest.mark.asyncio
-async def test_get_service_principal_id_odata_error(mock_graph_service_client, caplog):
-    """Tests ODataError during service principal retrieval."""
-    error = ODataError(error=MainError(message="Test OData Error"))
-    mock_graph_service_client.service_principals.get.side_effect = error
+    mock_response.odata_count = 0
+    mock_response.odata_next_link = None
+    get_graph_call(mock_graph_service_client).return_value = mock_response
+
+    result = await invoke(mock_graph_service_client)
+    assert result == expected
+
+_ODATA_ERROR_CASES = [
+    pytest.param(
+        lambda client: client.service_principals.get,
+        lambda client: scim_syncer.get_service_principal_id(client, TEST_APP_ID),
+        f"OData error retrieving service principal for app ID {TEST_APP_ID}: Test OData Error",
+        id="get_service_principal_id",
+    ),
+    pytest.param(
+        lambda client: client.service_principals.by_service_principal_id.return_value.synchronization.jobs.get,
+        lambda client: scim_syncer.get_synchronization_job_id(client, TEST_SP_ID),
+        "OData error retrieving synchronization jobs: Test OData Error",
+        id="get_synchronization_job_id",
+    ),
+    pytest.param(
+        lambda client: (
+            client.service_principals.by_service_principal_id.return_value
+            .synchronization.jobs.by_synchronization_job_id.return_value.start.post
+        ),
+        lambda client: scim_syncer.start_synchronization_job(client, TEST_SP_ID, TEST_JOB_ID),
+        "OData error starting synchronization job: Test OData Error",
+        id="start_synchronization_job",
+    ),
+]
+
+@pytest.mark.parametrize("get_graph_call,invoke,expected_log", _ODATA_ERROR_CASES)
+async def test_sync_helpers_odata_error(mock_graph_service_client, caplog, get_graph_call, invoke, expected_log):
+    """Tests that ODataError from Graph is logged and re-raised by each sync helper."""
+    get_graph_call(mock_graph_service_client).side_effect = _ODATA_ERROR
 
     with pytest.raises(ODataError):
-        await scim_syncer.get_service_principal_id(mock_graph_service_client, TEST_APP_ID)
-    assert f"OData error retrieving service principal for app ID {TEST_APP_ID}: Test OData Error" in caplog.text
+        await invoke(mock_graph_service_client)
+    assert expected_log in caplog.text
 
-@pytest.mark.asyncio
 async def test_get_synchronization_job_id_success(mock_graph_service_client):
     """Tests successful retrieval of synchronization job ID."""
-    job = SynchronizationJob(id=TEST_JOB_ID)
     mock_response = MagicMock()
-    mock_response.value = [job]
+    mock_response.value = [_TEST_JOB]
     mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
     mock_sp_item.synchronization.jobs.get.return_value = mock_response
 
@@ -171,117 +345,129 @@ async def test_get_synchronization_job_id_success(mock_graph_service_client):
     mock_sp_item.synchronization.jobs.get.assert_called_once()
     assert job_id == TEST_JOB_ID
 
-@pytest.mark.asyncio
-async def test_get_synchronization_job_id_not_found(mock_graph_service_client):
-    """Tests synchronization job not found."""
-    mock_response = MagicMock()
-    mock_response.value = []
-    mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
-    mock_sp_item.synchronization.jobs.get.return_value = mock_response
-
-    job_id = await scim_syncer.get_synchronization_job_id(mock_graph_service_client, TEST_SP_ID)
-    assert job_id is None
-
-@pytest.mark.asyncio
-async def test_get_synchronization_job_id_odata_error(mock_graph_service_client, caplog):
-    """Tests ODataError during synchronization job retrieval."""
-    error = ODataError(error=MainError(message="Job OData Error"))
-    mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
-    mock_sp_item.synchronization.jobs.get.side_effect = error
-
-    with pytest.raises(ODataError):
-        await scim_syncer.get_synchronization_job_id(mock_graph_service_client, TEST_SP_ID)
-
-@pytest.mark.asyncio
 async def test_start_synchronization_job_success(mock_graph_service_client):
     """Tests successful start of synchronization job."""
-    mock_job_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value.synchronization.jobs.by_synchronization_job_id.return_value
+    mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
+    mock_job_item = mock_sp_item.synchronization.jobs.by_synchronization_job_id.return_value
     mock_job_item.start.post.return_value = None # Simulating a successful void response
 
     await scim_syncer.start_synchronization_job(mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID)
 
     mock_graph_service_client.service_principals.by_service_principal_id.assert_called_with(TEST_SP_ID)
-    mock_graph_service_client.service_principals.by_service_principal_id.return_value.synchronization.jobs.by_synchronization_job_id.assert_called_with(TEST_JOB_ID)
+    mock_sp_item.synchronization.jobs.by_synchronization_job_id.assert_called_with(TEST_JOB_ID)
     mock_job_item.start.post.assert_called_once()
 
-@pytest.mark.asyncio
-async def test_start_synchronization_job_odata_error(mock_graph_service_client, caplog):
-    """Tests ODataError during starting synchronization job."""
-    error = ODataError(error=MainError(message="Start Job OData Error"))
-    mock_job_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value.synchronization.jobs.by_synchronization_job_id.return_value
-    mock_job_item.start.post.side_effect = error
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
+async def test_resolve_sync_target_caches_lookups(mock_get_job_id, mock_get_sp_id, mock_graph_service_client):
+    """Tests that resolve_sync_target only hits Graph once within the cache TTL."""
+    first = await scim_syncer.resolve_sync_target(mock_graph_service_client, TEST_APP_ID)
+    second = await scim_syncer.resolve_sync_target(mock_graph_service_client, TEST_APP_ID)
 
-    with pytest.raises(ODataError):
-        await scim_syncer.start_synchronization_job(mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID)
-    assert "OData error starting synchronization job: Start Job OData Error" in caplog.text
-
-@patch("scim_syncer.get_graph_client")
-@patch("scim_syncer.get_service_principal_id")
-@patch("scim_syncer.get_synchronization_job_id")
-@patch("scim_syncer.start_synchronization_job")
-@pytest.mark.asyncio
-async def test_main_success(
-    mock_start_job, mock_get_job_id, mock_get_sp_id, mock_get_client, caplog
+    assert first == (TEST_SP_ID, TEST_JOB_ID)
+    assert second == (TEST_SP_ID, TEST_JOB_ID)
+    mock_get_sp_id.assert_called_once_with(mock_graph_service_client, TEST_APP_ID)
+    mock_get_job_id.assert_called_once_with(mock_graph_service_client, TEST_SP_ID)
+
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
+async def test_resolve_sync_target_invalidation_forces_lookup(mock_get_job_id, mock_get_sp_id, mock_graph_service_client):
+    """Tests that invalidate_sync_target drops the cached pair."""
+    await scim_syncer.resolve_sync_target(mock_graph_service_client, TEST_APP_ID)
+    scim_syncer.invalidate_sync_target(TEST_APP_ID)
+    await scim_syncer.resolve_sync_target(mock_graph_service_client, TEST_APP_ID)
+
+    assert mock_get_sp_id.call_count == 2
+
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=None)
+async def test_resolve_sync_target_sp_not_found_not_cached(mock_get_sp_id, mock_graph_service_client):
+    """Tests that a missing service principal is not cached."""
+    result = await scim_syncer.resolve_sync_target(mock_graph_service_client, TEST_APP_ID)
+    assert result == (None, None)
+    await scim_syncer.resolve_sync_target(mock_graph_service_client, TEST_APP_ID)
+    assert mock_get_sp_id.call_count == 2
+
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock)
+async def test_resolve_sync_target_env_override_skips_discovery(
+    mock_get_job_id, mock_get_sp_id, mock_graph_service_client, monkeypatch
 ):
+    """Tests that AZURE_SP_OBJECT_ID / AZURE_SYNC_JOB_ID bypass both Graph lookups."""
+    monkeypatch.setenv("AZURE_SP_OBJECT_ID", "env-sp-id")
+    monkeypatch.setenv("AZURE_SYNC_JOB_ID", "env-job-id")
+
+    result = await scim_syncer.resolve_sync_target(mock_graph_service_client, TEST_APP_ID)
+
+    assert result == ("env-sp-id", "env-job-id")
+    mock_get_sp_id.assert_not_called()
+    mock_get_job_id.assert_not_called()
+
+@pytest.fixture
+def patched_scim():
+    """Patches main()'s Graph helpers in a single patch.multiple context.
+
+    One context is cheaper than a stack of @patch decorators and lets tests
+    configure the mocks by name instead of positional arguments.
+    """
+    with patch.multiple(
+        "scim_syncer",
+        get_graph_client=DEFAULT,
+        get_service_principal_id=DEFAULT,
+        get_synchronization_job_id=DEFAULT,
+        start_synchronization_job=DEFAULT,
+    ) as mocks:
+        mocks["get_graph_client"].return_value = AsyncMock()
+        yield mocks
+
+async def test_main_success(patched_scim, caplog):
     """Tests the main function happy path."""
-    mock_get_client.return_value = AsyncMock(spec=GraphServiceClient)
-    mock_get_sp_id.return_value = TEST_SP_ID
-    mock_get_job_id.return_value = TEST_JOB_ID
-    mock_start_job.return_value = None
+    patched_scim["get_service_principal_id"].return_value = TEST_SP_ID
+    patched_scim["get_synchronization_job_id"].return_value = TEST_JOB_ID
+    patched_scim["start_synchronization_job"].return_value = None
 
     await scim_syncer.main()
 
-    mock_get_client.assert_called_once()
-    mock_get_sp_id.assert_called_once_with(mock_get_client.return_value, TEST_APP_ID)
-    mock_get_job_id.assert_called_once_with(mock_get_client.return_value, TEST_SP_ID)
-    mock_start_job.assert_called_once_with(mock_get_client.return_value, TEST_SP_ID, TEST_JOB_ID)
+    graph_client = patched_scim["get_graph_client"].return_value
+    patched_scim["get_graph_client"].assert_called_once()
+    patched_scim["get_service_principal_id"].assert_called_once_with(graph_client, TEST_APP_ID)
+    patched_scim["get_synchronization_job_id"].assert_called_once_with(graph_client, TEST_SP_ID)
+    patched_scim["start_synchronization_job"].assert_called_once_with(graph_client, TEST_SP_ID, TEST_JOB_ID)
     assert "SCIM provisioning process completed successfully." in caplog.text
 
-@patch("scim_syncer.get_graph_client")
-@patch("scim_syncer.get_service_principal_id", return_value=None) # SP not found
-@pytest.mark.asyncio
-async def test_main_sp_not_found(mock_get_sp_id, mock_get_client, caplog):
+async def test_main_sp_not_found(patched_scim, caplog):
     """Tests main function when service principal is not found."""
-    mock_get_client.return_value = AsyncMock(spec=GraphServiceClient)
+    patched_scim["get_service_principal_id"].return_value = None # SP not found
 
     await scim_syncer.main()
 
-    mock_get_sp_id.assert_called_once()
+    patched_scim["get_service_principal_id"].assert_called_once()
     assert f"Could not find service principal for app ID {TEST_APP_ID}. Exiting." in caplog.text
 
-@patch("scim_syncer.get_graph_client")
-@patch("scim_syncer.get_service_principal_id", return_value=TEST_SP_ID)
-@patch("scim_syncer.get_synchronization_job_id", return_value=None) # Job not found
-@pytest.mark.asyncio
-async def test_main_job_not_found(mock_get_job_id, mock_get_sp_id, mock_get_client, caplog):
+async def test_main_job_not_found(patched_scim, caplog):
     """Tests main function when synchronization job is not found."""
-    mock_get_client.return_value = AsyncMock(spec=GraphServiceClient)
+    patched_scim["get_service_principal_id"].return_value = TEST_SP_ID
+    patched_scim["get_synchronization_job_id"].return_value = None # Job not found
 
     await scim_syncer.main()
 
-    mock_get_job_id.assert_called_once()
+    patched_scim["get_synchronization_job_id"].assert_called_once()
     assert f"Could not find synchronization job for service principal ID {TEST_SP_ID}. Exiting." in caplog.text
 
-@patch("scim_syncer.get_graph_client")
-@patch("scim_syncer.get_service_principal_id", side_effect=Exception("SP Error"))
-@pytest.mark.asyncio
-async def test_main_general_exception(mock_get_sp_id, mock_get_client, caplog):
+async def test_main_general_exception(patched_scim, caplog):
     """Tests main function with a general exception."""
-    mock_get_client.return_value = AsyncMock(spec=GraphServiceClient)
+    patched_scim["get_service_principal_id"].side_effect = Exception("SP Error")
 
     await scim_syncer.main()
     assert "An error occurred during the SCIM provisioning process: SP Error" in caplog.text
 
 # --- Tests for Optional Functions ---
 
-@pytest.mark.asyncio
 async def test_get_assigned_groups_success(mock_graph_service_client):
     """Tests successful retrieval of assigned groups."""
-    assignment1 = AppRoleAssignment(principal_id=TEST_GROUP_ID_1, principal_type="Group")
-    # Set the principal_display_name attribute, which might be None if not present in the actual response
-    assignment1.principal_display_name = "Test Group 1 Name"
     mock_response = MagicMock()
-    mock_response.value = [assignment1]
+    mock_response.value = [_TEST_GROUP_ASSIGNMENT]
+    mock_response.odata_count = 1
+    mock_response.odata_next_link = None # Single page
     mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
     mock_sp_item.app_role_assigned_to.get.return_value = mock_response
 
@@ -290,51 +476,246 @@ async def test_get_assigned_groups_success(mock_graph_service_client):
     assert groups_info == expected_groups_info
     mock_sp_item.app_role_assigned_to.get.assert_called_once()
     call_args, call_kwargs = mock_sp_item.app_role_assigned_to.get.call_args
-    
+
+    # The request_configuration is a precomputed RequestConfiguration object
     assert "request_configuration" in call_kwargs
-    request_config_lambda = call_kwargs["request_configuration"] 
+    passed_config = call_kwargs["request_configuration"]
 
-    mock_req_config = MagicMock()
-    mock_req_config.query_parameters = MagicMock()
-    mock_req_config.query_parameters.filter = None
-    mock_req_config.query_parameters.select = None
+    assert passed_config.query_parameters.filter == "principalType eq 'Group'"
+    assert passed_config.query_parameters.select == ["principalId", "principalDisplayName"]
+    assert passed_config.query_parameters.top == 999
+    assert passed_config.query_parameters.count is True
+    assert passed_config.headers.get("ConsistencyLevel") == {"eventual"}
 
-    request_config_lambda(mock_req_config)
+@patch("scim_syncer.asyncio.sleep", new_callable=AsyncMock)
+async def test_get_assigned_groups_retries_on_throttle(mock_sleep, mock_graph_service_client, caplog):
+    """Tests that a throttled (429) call is retried with the Retry-After wait."""
+    mock_response = MagicMock()
+    mock_response.value = [_TEST_GROUP_ASSIGNMENT]
+    mock_response.odata_count = 1
+    mock_response.odata_next_link = None
+    mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
+    mock_sp_item.app_role_assigned_to.get.side_effect = [_THROTTLED_429_ERROR, mock_response]
 
-    assert mock_req_config.query_parameters.filter == "principalType eq 'Group'"
-    assert mock_req_config.query_parameters.select == ["principalId", "principalDisplayName"]
+    groups_info = await scim_syncer.get_assigned_groups(mock_graph_service_client, TEST_SP_ID)
+
+    assert len(groups_info) == 1
+    assert mock_sp_item.app_role_assigned_to.get.call_count == 2
+    mock_sleep.assert_awaited_once_with(2.0)
+
+@patch("scim_syncer.asyncio.sleep", new_callable=AsyncMock)
+async def test_get_assigned_groups_throttle_exhausts_retries(mock_sleep, mock_graph_service_client):
+    """Tests that persistent throttling eventually propagates the ODataError."""
+    mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
+    mock_sp_item.app_role_assigned_to.get.side_effect = _THROTTLED_503_ERROR
+
+    with pytest.raises(ODataError):
+        await scim_syncer.get_assigned_groups(mock_graph_service_client, TEST_SP_ID)
 
-@pytest.mark.asyncio
-async def test_get_assigned_groups_no_groups(mock_graph_service_client):
-    """Tests retrieval when no groups are assigned."""
+    assert mock_sp_item.app_role_assigned_to.get.call_count == scim_syncer.GRAPH_RETRY_MAX_ATTEMPTS
+
+async def test_get_assigned_groups_no_groups_short_circuit(mock_graph_service_client):
+    """Tests that a zero server-side $count short-circuits without paging."""
     mock_response = MagicMock()
     mock_response.value = []
+    mock_response.odata_count = 0
     mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
     mock_sp_item.app_role_assigned_to.get.return_value = mock_response
 
-    group_ids = await scim_syncer.get_assigned_groups(mock_graph_service_client, TEST_SP_ID)
-    assert group_ids == []
+    assert await scim_syncer.get_assigned_groups(mock_graph_service_client, TEST_SP_ID) == []
+    mock_sp_item.app_role_assigned_to.with_url.assert_not_called()
+
+async def test_get_assigned_groups_follows_next_link(mock_graph_service_client):
+    """Tests that assignment paging follows @odata.nextLink across pages."""
+    next_link = "https://graph.microsoft.com/v1.0/servicePrincipals/next-page"
+    page1 = MagicMock()
+    page1.value = [AppRoleAssignment(principal_id=TEST_GROUP_ID_1)]
+    page1.odata_count = 2
+    page1.odata_next_link = next_link
+    page2 = MagicMock()
+    page2.value = [AppRoleAssignment(principal_id="test-group-id-2")]
+    page2.odata_next_link = None
+
+    mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
+    mock_sp_item.app_role_assigned_to.get.return_value = page1
+    mock_sp_item.app_role_assigned_to.with_url.return_value.get = AsyncMock(return_value=page2)
+
+    groups_info = await scim_syncer.get_assigned_groups(mock_graph_service_client, TEST_SP_ID)
+
+    assert [group["id"] for group in groups_info] == [TEST_GROUP_ID_1, "test-group-id-2"]
+    mock_sp_item.app_role_assigned_to.with_url.assert_called_once_with(next_link)
 
-@pytest.mark.asyncio
 async def test_get_group_members_success(mock_graph_service_client):
-    """Tests successful retrieval of group members (users)."""
-    user1 = User(id=TEST_USER_ID_1)
-    # odata_type is usually @odata.type in actual responses, but the model property is odata_type
-    user1.odata_type = "#microsoft.graph.user" # Important for filtering if done in code
+    """Tests successful streaming of group members (users)."""
     mock_response = MagicMock()
-    mock_response.value = [user1]
+    mock_response.value = [_TEST_USER]
+    mock_response.odata_next_link = None # Single page
     mock_group_item = mock_graph_service_client.groups.by_group_id.return_value
-    mock_group_item.members.get.return_value = mock_response
+    mock_group_item.transitive_members.graph_user.get.return_value = mock_response
 
-    user_ids = await scim_syncer.get_group_members(mock_graph_service_client, TEST_GROUP_ID_1)
+    user_ids = [uid async for uid in scim_syncer.get_group_members(mock_graph_service_client, TEST_GROUP_ID_1)]
     assert user_ids == [TEST_USER_ID_1]
     mock_graph_service_client.groups.by_group_id.assert_called_with(TEST_GROUP_ID_1)
-    mock_group_item.members.get.assert_called_once()
+    mock_group_item.transitive_members.graph_user.get.assert_called_once()
+
+async def test_get_group_members_follows_next_link(mock_graph_service_client):
+    """Tests that paging follows @odata.nextLink across pages."""
+    next_link = "https://graph.microsoft.com/v1.0/groups/next-page"
+    page1 = MagicMock()
+    page1.value = [User(id="user-page-1")]
+    page1.odata_next_link = next_link
+    page2 = MagicMock()
+    page2.value = [User(id="user-page-2")]
+    page2.odata_next_link = None
+
+    mock_group_item = mock_graph_service_client.groups.by_group_id.return_value
+    mock_group_item.transitive_members.graph_user.get.return_value = page1
+    mock_group_item.transitive_members.graph_user.with_url.return_value.get = AsyncMock(return_value=page2)
+
+    user_ids = [uid async for uid in scim_syncer.get_group_members(mock_graph_service_client, TEST_GROUP_ID_1)]
+
+    assert user_ids == ["user-page-1", "user-page-2"]
+    mock_group_item.transitive_members.graph_user.with_url.assert_called_once_with(next_link)
+
+async def test_get_changed_group_member_ids_skips_removed(mock_graph_service_client):
+    """Tests that the delta fast path yields added users, skipping @removed and non-user entries."""
+    delta_group = MagicMock()
+    delta_group.additional_data = {
+        "members@delta": [
+            {"@odata.type": "#microsoft.graph.user", "id": TEST_USER_ID_1},
+            {"@odata.type": "#microsoft.graph.user", "id": "removed-user", "@removed": {"reason": "deleted"}},
+            # An added nested group must not be provisioned as a user.
+            {"@odata.type": "#microsoft.graph.group", "id": "nested-group-id"},
+        ]
+    }
+    mock_page = MagicMock()
+    mock_page.value = [delta_group]
+    mock_page.odata_next_link = None
+    mock_page.odata_delta_link = "https://graph.microsoft.com/v1.0/groups/delta?$deltatoken=new"
+    mock_graph_service_client.groups.delta.with_url.return_value.get = AsyncMock(return_value=mock_page)
+
+    added_ids, new_link = await scim_syncer.get_changed_group_member_ids(
+        mock_graph_service_client, TEST_GROUP_ID_1, "https://graph.microsoft.com/v1.0/groups/delta?$deltatoken=old"
+    )
+
+    assert added_ids == [TEST_USER_ID_1]
+    assert new_link == mock_page.odata_delta_link
+    mock_graph_service_client.groups.delta.with_url.assert_called_once_with(
+        "https://graph.microsoft.com/v1.0/groups/delta?$deltatoken=old"
+    )
+
+async def test_get_changed_group_member_ids_expired_link(mock_graph_service_client):
+    """Tests that an expired deltaLink (410 Gone) signals a full resync."""
+    mock_graph_service_client.groups.delta.with_url.return_value.get = AsyncMock(side_effect=_GONE_ERROR)
+
+    added_ids, new_link = await scim_syncer.get_changed_group_member_ids(
+        mock_graph_service_client, TEST_GROUP_ID_1, "expired-delta-link"
+    )
+
+    assert added_ids is None
+    assert new_link is None
+
+async def test_get_latest_group_delta_links_batch(mock_graph_service_client):
+    """Tests that deltaLink anchoring is batched and parsed per sub-response."""
+    import io
+
+    ok_item = MagicMock()
+    ok_item.status = 200
+    ok_item.body = io.BytesIO(b'{"@odata.deltaLink": "anchored-delta-link"}')
+    failed_item = MagicMock()
+    failed_item.status = 403
+    failed_item.body = None
+    mock_response = MagicMock()
+    mock_response.responses = {TEST_GROUP_ID_1: ok_item, "denied-group-id": failed_item}
+    mock_graph_service_client.batch.post.return_value = mock_response
+
+    links = await scim_syncer.get_latest_group_delta_links_batch(
+        mock_graph_service_client, [TEST_GROUP_ID_1, "denied-group-id"]
+    )
+
+    assert links == {TEST_GROUP_ID_1: "anchored-delta-link", "denied-group-id": None}
+    mock_graph_service_client.batch.post.assert_called_once()
+
+async def test_get_recently_provisioned_user_ids(mock_graph_service_client):
+    """Tests that recent successful provisioning events are read from the audit log."""
+    from datetime import datetime, timedelta, timezone
+
+    summary = MagicMock()
+    summary.source_identity = MagicMock()
+    summary.source_identity.id = TEST_USER_ID_1
+    mock_page = MagicMock()
+    mock_page.value = [summary]
+    mock_page.odata_next_link = None
+    mock_graph_service_client.audit_logs = MagicMock()
+    mock_graph_service_client.audit_logs.provisioning.get = AsyncMock(return_value=mock_page)
+
+    since = datetime.now(timezone.utc) - timedelta(hours=1)
+    user_ids = await scim_syncer.get_recently_provisioned_user_ids(
+        mock_graph_service_client, TEST_JOB_ID, since
+    )
+
+    assert user_ids == {TEST_USER_ID_1}
+    config = mock_graph_service_client.audit_logs.provisioning.get.call_args.kwargs["request_configuration"]
+    assert f"jobId eq '{TEST_JOB_ID}'" in config.query_parameters.filter
+    assert "statusInfo/status eq 'success'" in config.query_parameters.filter
+
+def test_delta_link_store_roundtrip(tmp_path, monkeypatch):
+    """Tests that delta link entries survive a save/load cycle and a missing store is empty."""
+    store_path = tmp_path / "delta_links.json"
+    monkeypatch.setattr(scim_syncer, "DELTA_LINK_STORE_PATH", str(store_path))
+
+    assert scim_syncer._load_delta_links() == {}
+    entry = {"link": "delta-link", "anchored_at": 1234567890.0}
+    scim_syncer._save_delta_links({TEST_GROUP_ID_1: entry})
+    assert scim_syncer._load_delta_links() == {TEST_GROUP_ID_1: entry}
+
+def test_delta_link_store_migrates_bare_links(tmp_path, monkeypatch):
+    """Tests that pre-anchor-time stores (bare link strings) load as epoch-0 entries."""
+    store_path = tmp_path / "delta_links.json"
+    monkeypatch.setattr(scim_syncer, "DELTA_LINK_STORE_PATH", str(store_path))
+    store_path.write_bytes(b'{"%s": "legacy-link"}' % TEST_GROUP_ID_1.encode())
+
+    assert scim_syncer._load_delta_links() == {
+        TEST_GROUP_ID_1: {"link": "legacy-link", "anchored_at": 0.0}
+    }
+
+async def test_get_group_members_bulk(mock_graph_service_client):
+    """Tests bulk member fetch via $expand, including fallback markers."""
+    small_group = MagicMock()
+    small_group.id = TEST_GROUP_ID_1
+    # The expansion is heterogeneous: nested groups must not be returned as
+    # provisionable user IDs.
+    small_group.transitive_members = [_TEST_USER, Group(id="nested-group-id")]
+    capped_group = MagicMock()
+    capped_group.id = "capped-group-id"
+    capped_group.transitive_members = [User(id=f"user-{i}") for i in range(scim_syncer.GRAPH_EXPAND_MEMBER_LIMIT)]
+    mock_response = MagicMock()
+    mock_response.value = [small_group, capped_group]
+    mock_graph_service_client.groups.get = AsyncMock(return_value=mock_response)
+
+    members_by_group = await scim_syncer.get_group_members_bulk(
+        mock_graph_service_client,
+        [
+            {"id": TEST_GROUP_ID_1, "displayName": "Test Group 1"},
+            {"id": "capped-group-id", "displayName": "Capped Group"},
+            {"id": "missing-group-id", "displayName": "Missing Group"},
+        ],
+    )
+
+    assert members_by_group[TEST_GROUP_ID_1] == [TEST_USER_ID_1] # nested group filtered out
+    # Expansion hit the cap, so the group must be re-read with paging.
+    assert members_by_group["capped-group-id"] is None
+    # Groups absent from the response also fall back to the paged fetch.
+    assert members_by_group["missing-group-id"] is None
+    mock_graph_service_client.groups.get.assert_called_once()
+    config = mock_graph_service_client.groups.get.call_args.kwargs["request_configuration"]
+    assert "id in (" in config.query_parameters.filter
+    assert config.headers.get("ConsistencyLevel") == {"eventual"}
 
-@pytest.mark.asyncio
 async def test_provision_user_on_demand_success(mock_graph_service_client):
     """Tests successful triggering of provisionOnDemand."""
-    mock_job_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value.synchronization.jobs.by_synchronization_job_id.return_value
+    mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
+    mock_job_item = mock_sp_item.synchronization.jobs.by_synchronization_job_id.return_value
     mock_job_item.provision_on_demand.post.return_value = None # Simulate success
 
     await scim_syncer.provision_user_on_demand(
@@ -348,44 +729,321 @@ async def test_provision_user_on_demand_success(mock_graph_service_client):
     assert kwargs['body'].object_id == TEST_USER_ID_1
     assert kwargs['body'].object_type_name == "User"
 
+async def test_provision_users_on_demand_batch_success(mock_graph_service_client):
+    """Tests successful $batch provisioning of multiple users."""
+    user_ids = [f"user-{i}" for i in range(3)]
+    mock_response = MagicMock()
+    mock_response.responses = {}
+    mock_response.get_response_status_codes.return_value = {str(i): 201 for i in range(3)}
+    mock_graph_service_client.batch.post.return_value = mock_response
+
+    succeeded = await scim_syncer.provision_users_on_demand_batch(
+        mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, user_ids
+    )
+
+    assert succeeded == 3
+    mock_graph_service_client.batch.post.assert_called_once()
+    mock_sp_item = mock_graph_service_client.service_principals.by_service_principal_id.return_value
+    mock_provision_builder = mock_sp_item.synchronization.jobs.by_synchronization_job_id.return_value.provision_on_demand
+    # One sub-request was built per user
+    assert mock_provision_builder.to_post_request_information.call_count == 3
+    bodies = [kwargs["body"] for args, kwargs in mock_provision_builder.to_post_request_information.call_args_list]
+    assert [body.object_id for body in bodies] == user_ids
+    assert all(body.object_type_name == "User" for body in bodies)
+
+async def test_provision_users_on_demand_batch_auth_failure_raises(mock_graph_service_client):
+    """Tests that a 403 sub-response is raised as fatal instead of logged and skipped."""
+    mock_response = MagicMock()
+    mock_response.responses = {}
+    mock_response.get_response_status_codes.return_value = {"0": 201, "1": 403}
+    mock_graph_service_client.batch.post.return_value = mock_response
+
+    with pytest.raises(ODataError) as exc_info:
+        await scim_syncer.provision_users_on_demand_batch(
+            mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, [TEST_USER_ID_1, "denied-user"]
+        )
+    assert exc_info.value.response_status_code == 403
+
+async def test_provision_users_on_demand_batch_chunks_requests(mock_graph_service_client):
+    """Tests that more than 20 users are split across multiple $batch POSTs."""
+    user_ids = [f"user-{i}" for i in range(25)]
+
+    def _status_codes_for_call():
+        # First chunk has 20 sub-requests, second has 5; both all-success.
+        sizes = iter([20, 5])
+        def _make():
+            size = next(sizes)
+            mock_response = MagicMock()
+            mock_response.responses = {}
+            mock_response.get_response_status_codes.return_value = {str(i): 200 for i in range(size)}
+            return mock_response
+        return _make
+
+    make_response = _status_codes_for_call()
+    mock_graph_service_client.batch.post.side_effect = lambda *a, **kw: make_response()
+
+    succeeded = await scim_syncer.provision_users_on_demand_batch(
+        mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, user_ids
+    )
+
+    assert succeeded == 25
+    assert mock_graph_service_client.batch.post.call_count == 2
+
+@patch("scim_syncer.asyncio.sleep", new_callable=AsyncMock)
+async def test_provision_users_on_demand_batch_retries_throttled(mock_sleep, mock_graph_service_client, caplog):
+    """Tests that throttled (429) sub-requests are retried and eventually succeed."""
+    throttled_response = MagicMock()
+    throttled_response.responses = {}
+    throttled_response.get_response_status_codes.return_value = {"0": 429}
+    success_response = MagicMock()
+    success_response.responses = {}
+    success_response.get_response_status_codes.return_value = {"0": 204}
+    mock_graph_service_client.batch.post.side_effect = [throttled_response, success_response]
+
+    succeeded = await scim_syncer.provision_users_on_demand_batch(
+        mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, [TEST_USER_ID_1]
+    )
+
+    assert succeeded == 1
+    assert mock_graph_service_client.batch.post.call_count == 2
+    mock_sleep.assert_awaited_once()
+
 @patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock)
 @patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock)
 @patch("scim_syncer.get_assigned_groups", new_callable=AsyncMock)
-@patch("scim_syncer.get_group_members", new_callable=AsyncMock)
-@patch("scim_syncer.provision_user_on_demand", new_callable=AsyncMock)
-@pytest.mark.asyncio
+@patch("scim_syncer.get_group_members_bulk", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members")
+@patch("scim_syncer.provision_users_on_demand_batch", new_callable=AsyncMock)
+@patch("scim_syncer.get_latest_group_delta_link", new_callable=AsyncMock, return_value=None)
+@patch("scim_syncer.get_latest_group_delta_links_batch", new_callable=AsyncMock, return_value={})
 async def test_provision_all_users_on_demand_in_app_happy_path(
-    mock_provision_user, mock_get_group_members, mock_get_assigned_groups, 
-    mock_get_sync_job_id, mock_get_sp_id, mock_graph_service_client, caplog
+    mock_anchor_links_batch, mock_anchor_link,
+    mock_provision_batch, mock_get_group_members, mock_get_members_bulk,
+    mock_get_assigned_groups, mock_get_sync_job_id, mock_get_sp_id,
+    mock_graph_service_client, caplog
 ):
     """Tests the orchestration for on-demand provisioning of all users."""
     mock_get_sp_id.return_value = TEST_SP_ID
     mock_get_sync_job_id.return_value = TEST_JOB_ID
     mock_get_assigned_groups.return_value = [{"id": TEST_GROUP_ID_1, "displayName": "Test Group 1"}]
-    mock_get_group_members.return_value = [TEST_USER_ID_1]
-    mock_provision_user.return_value = None
+    mock_get_members_bulk.return_value = {TEST_GROUP_ID_1: [TEST_USER_ID_1]}
+    mock_provision_batch.return_value = 1
 
     await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
 
     mock_get_sp_id.assert_called_once_with(mock_graph_service_client, TEST_APP_ID)
     mock_get_sync_job_id.assert_called_once_with(mock_graph_service_client, TEST_SP_ID)
     mock_get_assigned_groups.assert_called_once_with(mock_graph_service_client, TEST_SP_ID)
-    mock_get_group_members.assert_called_once_with(mock_graph_service_client, TEST_GROUP_ID_1)
-    mock_provision_user.assert_called_once_with(
-        mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, TEST_USER_ID_1
+    # The bulk $expand fetch fully resolved the group, so no paged fallback.
+    mock_get_members_bulk.assert_called_once()
+    mock_get_group_members.assert_not_called()
+    mock_provision_batch.assert_called_once_with(
+        mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, [TEST_USER_ID_1],
+        provision_on_demand_builder=ANY,
     )
     expected_log_message = f"Completed on-demand provisioning process for users in App ID: {TEST_APP_ID} (SP ID: {TEST_SP_ID})."
     assert expected_log_message in caplog.text
 
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
+@patch("scim_syncer.get_assigned_groups", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members_bulk", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members")
+@patch("scim_syncer.provision_users_on_demand_batch", new_callable=AsyncMock)
+@patch("scim_syncer.get_latest_group_delta_link", new_callable=AsyncMock, return_value=None)
+@patch("scim_syncer.get_latest_group_delta_links_batch", new_callable=AsyncMock, return_value={})
+async def test_provision_all_users_on_demand_in_app_fans_out_batches(
+    mock_anchor_links_batch, mock_anchor_link,
+    mock_provision_batch, mock_get_group_members, mock_get_members_bulk,
+    mock_get_assigned_groups, mock_get_sync_job_id, mock_get_sp_id,
+    mock_graph_service_client
+):
+    """Tests that a large membership is split into multiple capped $batch calls."""
+    user_ids = [f"user-{i}" for i in range(2 * scim_syncer.GRAPH_BATCH_SIZE)]
+    mock_get_assigned_groups.return_value = [{"id": TEST_GROUP_ID_1, "displayName": "Test Group 1"}]
+    mock_get_members_bulk.return_value = {TEST_GROUP_ID_1: user_ids}
+    # Yield inside each batch call so the workers genuinely interleave.
+    async def _slow_batch(client, sp_id, job_id, batch_user_ids, provision_on_demand_builder=None):
+        await asyncio.sleep(0)
+        return len(batch_user_ids)
+    mock_provision_batch.side_effect = _slow_batch
+
+    await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
+
+    assert mock_provision_batch.call_count >= 2
+    provisioned = []
+    for call in mock_provision_batch.call_args_list:
+        batch_user_ids = call.args[3]
+        assert len(batch_user_ids) <= scim_syncer.GRAPH_BATCH_SIZE
+        provisioned.extend(batch_user_ids)
+    assert sorted(provisioned) == sorted(user_ids)
+
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
+@patch("scim_syncer.get_assigned_groups", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members_bulk", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members")
+@patch("scim_syncer.provision_users_on_demand_batch", new_callable=AsyncMock)
+@patch("scim_syncer.get_latest_group_delta_link", new_callable=AsyncMock, return_value=None)
+@patch("scim_syncer.get_latest_group_delta_links_batch", new_callable=AsyncMock, return_value={})
+async def test_provision_all_users_on_demand_in_app_dedupes_users_across_groups(
+    mock_anchor_links_batch, mock_anchor_link,
+    mock_provision_batch, mock_get_group_members, mock_get_members_bulk,
+    mock_get_assigned_groups, mock_get_sync_job_id, mock_get_sp_id,
+    mock_graph_service_client, caplog
+):
+    """Tests that a user in several assigned groups is only provisioned once."""
+    mock_get_assigned_groups.return_value = [
+        {"id": TEST_GROUP_ID_1, "displayName": "Test Group 1"},
+        {"id": "test-group-id-2", "displayName": "Test Group 2"},
+    ]
+    # Both groups need the paged fallback, exercising the streaming dedupe path.
+    mock_get_members_bulk.return_value = {TEST_GROUP_ID_1: None, "test-group-id-2": None}
+    mock_get_group_members.side_effect = [
+        _async_iter([TEST_USER_ID_1, "user-a"]),
+        _async_iter([TEST_USER_ID_1, "user-b"]),
+    ]
+
+    await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
+
+    provisioned = [
+        uid
+        for args, kwargs in mock_provision_batch.call_args_list
+        for uid in args[3]
+    ]
+    assert sorted(provisioned) == sorted([TEST_USER_ID_1, "user-a", "user-b"])
+    assert "already enqueued via another assigned group" in caplog.text
+
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
+@patch("scim_syncer.get_assigned_groups", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members_bulk", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members")
+@patch("scim_syncer.provision_users_on_demand_batch", new_callable=AsyncMock)
+@patch("scim_syncer.get_latest_group_delta_link", new_callable=AsyncMock, return_value=None)
+@patch("scim_syncer.get_latest_group_delta_links_batch", new_callable=AsyncMock, return_value={})
+async def test_provision_all_users_on_demand_in_app_group_fetch_failure_continues(
+    mock_anchor_links_batch, mock_anchor_link,
+    mock_provision_batch, mock_get_group_members, mock_get_members_bulk,
+    mock_get_assigned_groups, mock_get_sync_job_id, mock_get_sp_id,
+    mock_graph_service_client, caplog
+):
+    """Tests that a failed group-member fetch does not prevent other groups from provisioning."""
+    failing_group = {"id": "failing-group-id", "displayName": "Failing Group"}
+    mock_get_assigned_groups.return_value = [
+        failing_group,
+        {"id": TEST_GROUP_ID_1, "displayName": "Test Group 1"},
+    ]
+    mock_get_members_bulk.return_value = {"failing-group-id": None, TEST_GROUP_ID_1: None}
+    mock_get_group_members.side_effect = [Exception("Members fetch failed"), _async_iter([TEST_USER_ID_1])]
+
+    await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
+
+    mock_provision_batch.assert_called_once_with(
+        mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, [TEST_USER_ID_1],
+        provision_on_demand_builder=ANY,
+    )
+    assert "Failed to retrieve members for group 'Failing Group' (ID: failing-group-id)." in caplog.text
+
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
+@patch("scim_syncer.get_assigned_groups", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members_bulk", new_callable=AsyncMock)
+@patch("scim_syncer.provision_users_on_demand_batch", new_callable=AsyncMock)
+@patch("scim_syncer.get_latest_group_delta_link", new_callable=AsyncMock, return_value=None)
+@patch("scim_syncer.get_latest_group_delta_links_batch", new_callable=AsyncMock, return_value={})
+async def test_provision_all_users_on_demand_in_app_aborts_on_auth_failure(
+    mock_anchor_links_batch, mock_anchor_link,
+    mock_provision_batch, mock_get_members_bulk, mock_get_assigned_groups,
+    mock_get_sync_job_id, mock_get_sp_id, mock_graph_service_client, caplog
+):
+    """Tests that a 403 during provisioning aborts the run instead of continuing."""
+    mock_get_assigned_groups.return_value = [{"id": TEST_GROUP_ID_1, "displayName": "Test Group 1"}]
+    mock_get_members_bulk.return_value = {TEST_GROUP_ID_1: [TEST_USER_ID_1]}
+    mock_provision_batch.side_effect = _FORBIDDEN_ERROR
+
+    with pytest.raises(ODataError):
+        await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
+
+    assert "Authorization failure (HTTP 403)" in caplog.text
+
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
+@patch("scim_syncer.get_assigned_groups", new_callable=AsyncMock)
+@patch("scim_syncer._load_delta_links")
+@patch("scim_syncer._save_delta_links")
+@patch("scim_syncer.get_changed_group_member_ids", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members_bulk", new_callable=AsyncMock)
+@patch("scim_syncer.provision_users_on_demand_batch", new_callable=AsyncMock)
+async def test_provision_all_users_on_demand_in_app_uses_delta_fast_path(
+    mock_provision_batch, mock_get_members_bulk, mock_get_changed_ids,
+    mock_save_links, mock_load_links, mock_get_assigned_groups,
+    mock_get_sync_job_id, mock_get_sp_id, mock_graph_service_client, caplog
+):
+    """Tests that a group with a persisted deltaLink only provisions added members."""
+    anchored_at = time.time()
+    mock_get_assigned_groups.return_value = [{"id": TEST_GROUP_ID_1, "displayName": "Test Group 1"}]
+    mock_load_links.return_value = {
+        TEST_GROUP_ID_1: {"link": "stored-delta-link", "anchored_at": anchored_at}
+    }
+    mock_get_changed_ids.return_value = (["added-user-id"], "new-delta-link")
+
+    await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
+
+    mock_get_changed_ids.assert_called_once_with(
+        mock_graph_service_client, TEST_GROUP_ID_1, "stored-delta-link"
+    )
+    # The delta fast path replaces the full bulk fetch entirely.
+    mock_get_members_bulk.assert_not_called()
+    mock_provision_batch.assert_called_once_with(
+        mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, ["added-user-id"],
+        provision_on_demand_builder=ANY,
+    )
+    # Advancing the link must not reset the anchor time that drives the
+    # periodic full resync.
+    mock_save_links.assert_called_once_with(
+        {TEST_GROUP_ID_1: {"link": "new-delta-link", "anchored_at": anchored_at}}
+    )
+
+@patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
+@patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
+@patch("scim_syncer.get_assigned_groups", new_callable=AsyncMock)
+@patch("scim_syncer._load_delta_links")
+@patch("scim_syncer._save_delta_links")
+@patch("scim_syncer.get_latest_group_delta_links_batch", new_callable=AsyncMock, return_value={})
+@patch("scim_syncer.get_changed_group_member_ids", new_callable=AsyncMock)
+@patch("scim_syncer.get_group_members_bulk", new_callable=AsyncMock)
+@patch("scim_syncer.provision_users_on_demand_batch", new_callable=AsyncMock)
+async def test_provision_all_users_on_demand_in_app_stale_delta_link_full_resync(
+    mock_provision_batch, mock_get_members_bulk, mock_get_changed_ids,
+    mock_anchor_links, mock_save_links, mock_load_links, mock_get_assigned_groups,
+    mock_get_sync_job_id, mock_get_sp_id, mock_graph_service_client
+):
+    """Tests that a link older than DELTA_FULL_RESYNC_HOURS forces a full resync."""
+    stale = time.time() - (scim_syncer.DELTA_FULL_RESYNC_HOURS + 1) * 3600
+    mock_get_assigned_groups.return_value = [{"id": TEST_GROUP_ID_1, "displayName": "Test Group 1"}]
+    mock_load_links.return_value = {
+        TEST_GROUP_ID_1: {"link": "stale-delta-link", "anchored_at": stale}
+    }
+    mock_get_members_bulk.return_value = {TEST_GROUP_ID_1: [TEST_USER_ID_1]}
+
+    await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
+
+    # The aged link was discarded, so the delta fast path must not run.
+    mock_get_changed_ids.assert_not_called()
+    mock_get_members_bulk.assert_called_once()
+    mock_provision_batch.assert_called_once_with(
+        mock_graph_service_client, TEST_SP_ID, TEST_JOB_ID, [TEST_USER_ID_1],
+        provision_on_demand_builder=ANY,
+    )
+
 @patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=None)
-@pytest.mark.asyncio
 async def test_provision_all_users_on_demand_in_app_no_sp(mock_get_sp_id, mock_graph_service_client, caplog):
     await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
     assert f"Cannot perform on-demand provisioning: Service principal not found for app {TEST_APP_ID}." in caplog.text
 
 @patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
 @patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=None)
-@pytest.mark.asyncio
 async def test_provision_all_users_on_demand_in_app_no_job(mock_get_sync_job_id, mock_get_sp_id, mock_graph_service_client, caplog):
     await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
     assert f"Cannot perform on-demand provisioning: Sync job not found for SP {TEST_SP_ID}." in caplog.text
@@ -393,7 +1051,6 @@ async def test_provision_all_users_on_demand_in_app_no_job(mock_get_sync_job_id,
 @patch("scim_syncer.get_service_principal_id", new_callable=AsyncMock, return_value=TEST_SP_ID)
 @patch("scim_syncer.get_synchronization_job_id", new_callable=AsyncMock, return_value=TEST_JOB_ID)
 @patch("scim_syncer.get_assigned_groups", new_callable=AsyncMock, return_value=[])
-@pytest.mark.asyncio
 async def test_provision_all_users_on_demand_in_app_no_groups(mock_get_assigned_groups, mock_get_sync_job_id, mock_get_sp_id, mock_graph_service_client, caplog):
     await scim_syncer.provision_all_users_on_demand_in_app(mock_graph_service_client, TEST_APP_ID)
     expected_log_message = f"No groups assigned to the application (App ID: {TEST_APP_ID}, SP ID: {TEST_SP_ID}). Nothing to provision on demand."
@@ -405,8 +1062,25 @@ async def test_provision_all_users_on_demand_in_app_no_groups(mock_get_assigned_
 # def test_main_entry_point_runs_main(...)
 # def test_main_entry_point_runs_on_demand(...)
 
+def test_config_from_env(monkeypatch):
+    """Tests that Config.from_env parses the environment once into a frozen object."""
+    monkeypatch.setenv("RUN_ON_DEMAND_PROVISIONING", "TRUE")
+    config = scim_syncer.Config.from_env()
+    assert config.app_id == TEST_APP_ID
+    assert config.on_demand is True
+    with pytest.raises(AttributeError):
+        config.app_id = "other"
+
+@patch("scim_syncer.asyncio.run")
+def test_run_entrypoint_runs_cli(mock_asyncio_run):
+    """Tests that run_entrypoint drives cli_entry_point through asyncio.run."""
+    scim_syncer.run_entrypoint()
+    mock_asyncio_run.assert_called_once()
+    coro = mock_asyncio_run.call_args[0][0]
+    assert coro.cr_code is scim_syncer.cli_entry_point.__code__
+    coro.close()
+
 # Add new tests for cli_entry_point
-@pytest.mark.asyncio
 @patch("scim_syncer.main", new_callable=AsyncMock) # Mock the target function
 @patch.dict(os.environ, {"RUN_ON_DEMAND_PROVISIONING": "false"}, clear=True) # Ensure only this var is set for the test
 async def test_cli_entry_point_runs_main(mock_main_func, caplog):
@@ -415,7 +1089,6 @@ async def test_cli_entry_point_runs_main(mock_main_func, caplog):
     mock_main_func.assert_awaited_once()
     assert "Running main synchronization job." in caplog.text
 
-@pytest.mark.asyncio
 @patch("scim_syncer.get_graph_client", new_callable=AsyncMock) # Mock dependency
 @patch("scim_syncer.provision_all_users_on_demand_in_app", new_callable=AsyncMock) # Mock target function
 @patch.dict(os.environ, {"RUN_ON_DEMAND_PROVISIONING": "true", "AZURE_APP_ID": TEST_APP_ID}, clear=True) # Set env vars for this test
@@ -430,7 +1103,6 @@ async def test_cli_entry_point_runs_on_demand(mock_on_demand_func, mock_get_grap
     mock_on_demand_func.assert_awaited_once_with(mock_client, TEST_APP_ID)
     assert "RUN_ON_DEMAND_PROVISIONING is true, running on-demand sync." in caplog.text
 
-@pytest.mark.asyncio
 @patch("scim_syncer.get_graph_client", new_callable=AsyncMock)
 @patch("scim_syncer.provision_all_users_on_demand_in_app", new_callable=AsyncMock)
 @patch.dict(os.environ, {"RUN_ON_DEMAND_PROVISIONING": "true"}, clear=True) # AZURE_APP_ID is MISSING